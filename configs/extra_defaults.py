@@ -72,6 +72,12 @@ _C.PREPROCESS.DISABLE_CHECK = False
 # Overwrite existing files in temporary directory
 _C.PREPROCESS.OVERWRITE = False
 
+# Save resized JPEG images as JPEG instead of the image output format
+_C.PREPROCESS.KEEP_JPEG = False
+
+# Decode and resize JPEG images on the GPU (nvJPEG) when CUDA is available
+_C.PREPROCESS.GPU_DECODE = False
+
 # PageXML region conversion
 _C.PREPROCESS.REGION = CN()
 _C.PREPROCESS.REGION.REGIONS = []
@@ -79,7 +79,8 @@ class ResizeTransform(T.Transform):
         Returns:
             np.ndarray: resized images
         """
-        img = img.astype(np.uint8)
+        # Only convert when needed, the resize already creates a new array
+        img = img.astype(np.uint8, copy=False)
         old_height, old_width, channels = img.shape
         assert (old_height, old_width) == (self.height, self.width), "Input dims do not match specified dims"
 
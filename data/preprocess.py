@@ -2,15 +2,18 @@ import argparse
 import json
 import logging
 import os
+import pickle
+import shutil
 import sys
+import tempfile
 from collections import Counter, defaultdict
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from multiprocessing.pool import Pool
 from pathlib import Path
-from typing import Any, Optional, Sequence
+from typing import Any, BinaryIO, Optional, Sequence
 
 import cv2
 import detectron2.data.transforms as T
-import imagesize
 import numpy as np
 import torch
 from tqdm import tqdm
@@ -27,6 +30,7 @@ from page_xml.xml_converters import (
 sys.path.append(str(Path(__file__).resolve().parent.joinpath("..")))
 from detectron2.config import CfgNode, configurable
 
+from data import torch_transforms as TT
 from data.augmentations import (
     Augmentation,
     ResizeLongestEdge,
@@ -35,13 +39,96 @@ from data.augmentations import (
     build_augmentation,
 )
 from data.mapper import AugInput
-from page_xml.xml_converters.xml_converter import _XMLConverter
+from page_xml.page_xml_editor import PageXMLEditor
+from page_xml.xml_converters.xml_converter import _XMLConverter, reset_scratch, set_draw_threads
 from page_xml.xml_regions import XMLRegions
 from utils.copy_utils import copy_mode
-from utils.image_utils import load_image_array_from_path, save_image_array_to_path
+from utils.image_utils import (
+    load_image_array_from_path,
+    read_image_header,
+    save_image_array_to_path,
+)
+from utils.image_torch_utils import load_image_tensor_from_path_gpu_decode
 from utils.input_utils import SUPPORTED_IMAGE_FORMATS, get_file_paths
 from utils.logging_utils import get_logger_name
-from utils.path_utils import check_path_accessible, image_path_to_xml_path
+from utils.path_utils import check_paths_accessible, image_path_to_xml_path
+
+_ORJSON_IMPORTED = True
+try:
+    import orjson
+except ImportError:
+    # orjson is an optional dependency, it only speeds up writing the JSON files
+    _ORJSON_IMPORTED = False
+
+
+def json_dumps(data: Any) -> bytes:
+    """
+    Encode data as JSON, using orjson when available as it is a lot faster than the standard library for large annotations
+
+    Args:
+        data (Any): JSON serializable data
+
+    Returns:
+        bytes: the UTF-8 encoded JSON
+    """
+    if _ORJSON_IMPORTED:
+        return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(data).encode("utf-8")
+
+
+def save_json_to_path(data: Any, path: Path) -> None:
+    """
+    Save data as JSON
+
+    Args:
+        data (Any): JSON serializable data
+        path (Path): path to the output file
+    """
+    with path.open(mode="wb") as f:
+        f.write(json_dumps(data))
+
+
+# Converter used by each of the save_{output} methods
+CONVERTER_PER_OUTPUT: dict[str, type[_XMLConverter]] = {
+    "sem_seg": XMLToSemSeg,
+    "instances": XMLToInstances,
+    "pano": XMLToPano,
+    "binary_seg": XMLToBinarySeg,
+}
+
+# Preprocess instance of the current worker process, set once per worker by _init_worker
+_WORKER: Optional["Preprocess"] = None
+
+
+def _init_worker(preprocess_bytes: bytes) -> None:
+    """
+    Initialize a worker process of the preprocessing pool, so the Preprocess instance is only sent once per worker
+
+    Args:
+        preprocess_bytes (bytes): the pickled Preprocess instance used by the worker
+    """
+    global _WORKER
+    _WORKER = pickle.loads(preprocess_bytes)
+    reset_scratch()
+    # The pool already processes a file per core
+    set_draw_threads(1)
+    _WORKER.build_converters()
+
+
+def _worker_process(paths: tuple[Path, Path]) -> dict:
+    """
+    Process a single file using the Preprocess instance of the current worker
+
+    Args:
+        paths (tuple[Path, Path]): Path to input image and the corresponding PageXML
+
+    Returns:
+        dict: Preprocessing results
+    """
+    if _WORKER is None:
+        raise TypeError("Worker has not been initialized")
+    image_path, xml_path = paths
+    return _WORKER.process_single_file(image_path, xml_path)
 
 
 def get_arguments() -> argparse.Namespace:
@@ -81,6 +168,8 @@ class Preprocess:
         auto_dpi: bool = True,
         default_dpi: Optional[int] = None,
         manual_dpi: Optional[int] = None,
+        keep_jpeg: bool = False,
+        gpu_decode: bool = False,
     ) -> None:
         """
         Initializes the Preprocessor object.
@@ -96,6 +185,8 @@ class Preprocess:
             auto_dpi (bool, optional): Flag to automatically determine the DPI of the images. Defaults to True.
             default_dpi (int, optional): The default DPI to be used for resizing images. Defaults to None.
             manual_dpi (int, optional): The manually specified DPI to be used for resizing images. Defaults to None.
+            keep_jpeg (bool, optional): Save resized JPEG images as JPEG instead of the image output format. Defaults to False.
+            gpu_decode (bool, optional): Decode and resize JPEG images on the GPU when CUDA is available. Defaults to False.
 
         Raises:
             TypeError: If xml_converter is not an instance of XMLConverter.
@@ -110,6 +201,7 @@ class Preprocess:
             self.set_input_paths(input_paths)
 
         self.output_dir: Optional[Path] = None
+        self._output_dirs_created = False
         if output_dir is not None:
             self.set_output_dir(output_dir)
 
@@ -129,11 +221,86 @@ class Preprocess:
         self.output = output
 
         self.augmentations = augmentations
+        # A single deterministic resize is applied directly with cv2, skipping the detectron2 augmentation machinery
+        self._fast_resize = len(augmentations) == 1 and self.is_deterministic_resize(augmentations[0])
 
         self.auto_dpi = auto_dpi
         self.default_dpi = default_dpi
         self.manual_dpi = manual_dpi
 
+        self.keep_jpeg = keep_jpeg
+        self.gpu_decode = gpu_decode
+
+        # Set while processing a single file, so saving can overlap with the XML conversion
+        self._save_executor: Optional[ThreadPoolExecutor] = None
+        self._save_futures: list[Future] = []
+        # Size sidecars are written after the background saves finished, so a failed save is never marked as done
+        self._size_writes: list[tuple[Path, tuple[int, int]]] = []
+
+        # Names of the files already present in the output subdirs, scanned once at the start of run()
+        self._existing_outputs: Optional[dict[str, set[str]]] = None
+
+        # Converters are stateless, so they are created once per process on first use
+        self._converters: dict[type[_XMLConverter], _XMLConverter] = {}
+
+        # The PageXML of the file currently being processed, parsed once and shared between all outputs
+        self._current_page: Optional[tuple[Path, PageXMLEditor]] = None
+
+    def __getstate__(self) -> dict[str, Any]:
+        """
+        Get the state to pickle when sending the instance to a worker. The input paths, save executor and converters
+        are not needed (or not picklable) in a worker, so they are left out to keep the handshake small.
+
+        Returns:
+            dict[str, Any]: the state of the instance
+        """
+        state = self.__dict__.copy()
+        state["input_paths"] = None
+        state["_save_executor"] = None
+        state["_save_futures"] = []
+        state["_size_writes"] = []
+        state["_converters"] = {}
+        state["_current_page"] = None
+        return state
+
+    def build_converters(self) -> None:
+        """
+        Create the converters for all outputs upfront, so the setup is not part of the first processed file of a worker
+        """
+        for output in self.output:
+            if output in CONVERTER_PER_OUTPUT:
+                self._get_converter(CONVERTER_PER_OUTPUT[output])
+
+    def _get_converter(self, converter_class: type[_XMLConverter]) -> _XMLConverter:
+        """
+        Get the converter of the given class, creating it on first use
+
+        Args:
+            converter_class (type[_XMLConverter]): the class of the converter
+
+        Returns:
+            _XMLConverter: the converter
+        """
+        converter = self._converters.get(converter_class)
+        if converter is None:
+            converter = converter_class(self.xml_regions, square_lines=self.square_lines)
+            self._converters[converter_class] = converter
+        return converter
+
+    def load_page(self, xml_path: Path) -> PageXMLEditor:
+        """
+        Get the parsed PageXML, only parsing it the first time it is requested for the current file
+
+        Args:
+            xml_path (Path): the path to the PageXML
+
+        Returns:
+            PageXMLEditor: the parsed PageXML
+        """
+        if self._current_page is None or self._current_page[0] != xml_path:
+            self._current_page = (xml_path, PageXMLEditor(xml_path))
+        return self._current_page[1]
+
     @classmethod
     def from_config(
         cls,
@@ -174,6 +341,8 @@ class Preprocess:
             "auto_dpi": cfg.PREPROCESS.DPI.AUTO_DETECT,
             "default_dpi": cfg.PREPROCESS.DPI.DEFAULT_DPI,
             "manual_dpi": cfg.PREPROCESS.DPI.MANUAL_DPI,
+            "keep_jpeg": cfg.PREPROCESS.KEEP_JPEG,
+            "gpu_decode": cfg.PREPROCESS.GPU_DECODE,
         }
         return ret
 
@@ -218,6 +387,11 @@ class Preprocess:
         pre_process_args.add_argument("--default_dpi", type=int, help="Default DPI")
         pre_process_args.add_argument("--manual_dpi", type=int, help="Manually set DPI")
 
+        pre_process_args.add_argument(
+            "--keep_jpeg", action="store_true", help="Save resized JPEG images as JPEG instead of the image output format"
+        )
+        pre_process_args.add_argument("--gpu_decode", action="store_true", help="Decode and resize JPEG images on the GPU")
+
         return parser
 
     def set_input_paths(
@@ -251,22 +425,24 @@ class Preprocess:
         Raises:
             ValueError: If duplicate names are found in the input paths.
         """
-        count_duplicates_names = Counter([path.name for path in input_paths])
-        duplicates = defaultdict(list)
+        # Group by name in a single pass, only the groups with more than one path are duplicates
+        paths_per_name: defaultdict[str, list[Path]] = defaultdict(list)
         for path in input_paths:
-            if count_duplicates_names[path.name] > 1:
-                duplicates[path.name].append(path)
+            paths_per_name[path.name].append(path)
+        duplicates = {name: paths for name, paths in paths_per_name.items() if len(paths) > 1}
         if duplicates:
-            total_duplicates = sum(count_duplicates_names[name] for name in duplicates.keys())
+            total_duplicates = sum(len(paths) for paths in duplicates.values())
             count_per_dir = Counter([path.parent for path in input_paths])
             duplicates_in_dir = defaultdict(int)
             duplicates_makeup = defaultdict(lambda: defaultdict(int))
-            for name, paths in duplicates.items():
-                for path in paths:
-                    duplicates_in_dir[path.parent] += 1
-                    for other_path in duplicates[name]:
-                        if other_path.parent != path.parent:
-                            duplicates_makeup[path.parent][other_path.parent] += 1
+            for paths in duplicates.values():
+                # Count per directory, so the pairs are counted per directory instead of per path
+                count_per_parent = Counter(path.parent for path in paths)
+                for parent, parent_count in count_per_parent.items():
+                    duplicates_in_dir[parent] += parent_count
+                    for other_parent, other_parent_count in count_per_parent.items():
+                        if other_parent != parent:
+                            duplicates_makeup[parent][other_parent] += parent_count * other_parent_count
             duplicate_warning = "Duplicates found in the following directories:\n"
             for dir_path, count in count_per_dir.items():
                 duplicate_warning += f"Directory: {dir_path} Count: {duplicates_in_dir.get(dir_path, 0)}/{count}\n"
@@ -277,7 +453,7 @@ class Preprocess:
                     duplicate_warning += "\n"
             self.logger.warning(duplicate_warning.strip())
             raise ValueError(
-                f"Found duplicate names in input paths. \n\tDuplicates: {total_duplicates}/{len(input_paths)} \n\tTotal unique names: {len(count_duplicates_names)}"
+                f"Found duplicate names in input paths. \n\tDuplicates: {total_duplicates}/{len(input_paths)} \n\tTotal unique names: {len(paths_per_name)}"
             )
 
     def get_input_paths(self) -> Optional[Sequence[Path]]:
@@ -304,6 +480,20 @@ class Preprocess:
             output_dir.mkdir(parents=True)
 
         self.output_dir = output_dir.resolve()
+        self._output_dirs_created = False
+
+    def create_output_dirs(self) -> None:
+        """
+        Create the subdirs of all outputs once, instead of checking them for every saved file
+
+        Raises:
+            TypeError: If the output directory is None.
+        """
+        if self.output_dir is None:
+            raise TypeError("Cannot run when the output dir is None")
+        for output in self.output:
+            self.output_dir.joinpath(output).mkdir(parents=True, exist_ok=True)
+        self._output_dirs_created = True
 
     def get_output_dir(self) -> Optional[Path]:
         """
@@ -314,6 +504,43 @@ class Preprocess:
         """
         return self.output_dir
 
+    def scan_existing_outputs(self) -> dict[str, set[str]]:
+        """
+        Scan the output subdirs once, to avoid checking the existence of every output file separately.
+
+        Raises:
+            TypeError: If the output dir is None.
+
+        Returns:
+            dict[str, set[str]]: The names of the files in each of the output subdirs.
+        """
+        if self.output_dir is None:
+            raise TypeError("Cannot run when the output dir is None")
+
+        existing_outputs = {}
+        for output in self.output:
+            output_subdir = self.output_dir.joinpath(output)
+            if output_subdir.is_dir():
+                with os.scandir(output_subdir) as entries:
+                    existing_outputs[output] = {entry.name for entry in entries}
+            else:
+                existing_outputs[output] = set()
+        return existing_outputs
+
+    def output_exists(self, path: Path) -> bool:
+        """
+        Check if an output file exists, using the scan of the output dir if it is available.
+
+        Args:
+            path (Path): path to the output file.
+
+        Returns:
+            bool: True if the output file exists.
+        """
+        if self._existing_outputs is None or path.parent.name not in self._existing_outputs:
+            return path.exists()
+        return path.name in self._existing_outputs[path.parent.name]
+
     @staticmethod
     def check_paths_exists(paths: Sequence[Path]) -> None:
         """
@@ -321,15 +548,60 @@ class Preprocess:
         Args:
             paths (list[Path]): paths to be checked.
         """
-        all(check_path_accessible(path) for path in paths)
+        check_paths_accessible(paths)
+
+    @staticmethod
+    def read_size(path: Path) -> Optional[tuple[int, int]]:
+        """
+        Read the shape of a previously saved output from its size sidecar file.
+
+        Args:
+            path (Path): path to the size file.
+
+        Returns:
+            Optional[tuple[int, int]]: the height and width, None if the file could not be parsed.
+        """
+        try:
+            height, width = path.read_text().strip().split(",")
+            return int(height), int(width)
+        except ValueError:
+            return None
+
+    def write_size(self, path: Path, shape: tuple[int, int]) -> None:
+        """
+        Write the shape of an output to its size sidecar file. If a save executor is active the write is deferred until all saves finished.
+
+        Args:
+            path (Path): path to the size file.
+            shape (tuple[int, int]): the height and width of the output.
+        """
+        if self._save_executor is not None:
+            self._size_writes.append((path, shape))
+        else:
+            path.write_text(f"{shape[0]},{shape[1]}")
+
+    def save_array_to_path(self, array: np.ndarray | torch.Tensor, path: Path, label_mask: bool = False) -> None:
+        """
+        Save an array to a path with a specific method. If a save executor is active the save is done in the background.
+
+        Args:
+            array (np.ndarray): array to be saved.
+            path (Path): path to save the array.
+            label_mask (bool, optional): The array is a label mask, use fast lossless compression. Defaults to False.
+        """
+        if self._save_executor is not None:
+            self._save_futures.append(self._save_executor.submit(self._save_array_to_path, array, path, label_mask))
+        else:
+            self._save_array_to_path(array, path, label_mask)
 
-    def save_array_to_path(self, array: np.ndarray | torch.Tensor, path: Path) -> None:
+    def _save_array_to_path(self, array: np.ndarray | torch.Tensor, path: Path, label_mask: bool = False) -> None:
         """
         Save an array to a path with a specific method.
 
         Args:
             array (np.ndarray): array to be saved.
             path (Path): path to save the array.
+            label_mask (bool, optional): The array is a label mask, use fast lossless compression. Defaults to False.
         """
 
         method = path.suffix
@@ -343,7 +615,13 @@ class Preprocess:
             ), f"Array must be 2D or 3D with 3 channels to save an image, got {array.shape}"
             assert np.max(array) <= 255, f"Array must be in range 0-255 to save an image, got {np.max(array)}"
             assert np.min(array) >= 0, f"Array must be in range 0-255 to save an image, got {np.min(array)}"
-            save_image_array_to_path(path, array)
+            if label_mask:
+                # Label masks compress well, so the deflate level barely changes the size but is the slowest part of saving
+                save_image_array_to_path(path, array, compression=1, lossless=True)
+            elif method in [".jpg", ".jpeg"]:
+                save_image_array_to_path(path, array, quality=95)
+            else:
+                save_image_array_to_path(path, array)
         elif method == ".npy":
             if isinstance(array, torch.Tensor):
                 array = array.permute(1, 2, 0).cpu().numpy()
@@ -361,9 +639,77 @@ class Preprocess:
         else:
             raise NotImplementedError(f"Method {method} not implemented")
 
+    @staticmethod
+    def is_deterministic_resize(augmentation: Augmentation) -> bool:
+        """
+        Check if an augmentation is a resize that always gives the same output shape for the same input
+
+        Args:
+            augmentation (Augmentation): the augmentation to check
+
+        Returns:
+            bool: True if the augmentation is a deterministic resize
+        """
+        if isinstance(augmentation, ResizeScaling):
+            return True
+        if isinstance(augmentation, ResizeShortestEdge):
+            return len(set(augmentation.min_size)) == 1
+        return False
+
+    def use_gpu_decode(self, image_path: Path) -> bool:
+        """
+        Check if an image should be decoded and resized on the GPU.
+        Only a single deterministic resize is supported, and CUDA is checked here so it is only initialized in the workers.
+
+        Args:
+            image_path (Path): The path to the image file.
+
+        Returns:
+            bool: True if the image should be decoded on the GPU.
+        """
+        return (
+            self.gpu_decode
+            and self._fast_resize
+            and image_path.suffix.lower() in [".jpg", ".jpeg"]
+            and torch.cuda.is_available()
+        )
+
+    def load_resized_image_gpu(
+        self, image_path: Path, original_image_shape: tuple[int, int], image_shape: tuple[int, int]
+    ) -> np.ndarray:
+        """
+        Decode a JPEG image with nvJPEG and resize it on the GPU, only the resized image is copied back to the CPU.
+
+        Args:
+            image_path (Path): The path to the image file.
+            original_image_shape (tuple[int, int]): The original shape of the image, read from the header.
+            image_shape (tuple[int, int]): The desired shape of the image.
+
+        Raises:
+            TypeError: If the image loading fails.
+
+        Returns:
+            np.ndarray: The resized image (HxWxC).
+        """
+        data = load_image_tensor_from_path_gpu_decode(image_path, device=torch.device("cuda"))
+        if data is None:
+            raise TypeError(f"Image {image_path} is None, loading failed")
+        image = data["image"]
+        old_height, old_width = image.shape[-2:]
+        if (old_height, old_width) == original_image_shape:
+            # Use the shape computed from the header, so the image always matches the other outputs and the size file
+            height, width = image_shape
+        else:
+            # Rotated by its EXIF orientation, the header describes the stored (unrotated) image
+            height, width = self.augmentations[0].get_output_shape(old_height, old_width, dpi=self.get_dpi(data["dpi"]))
+        if (old_height, old_width) != (height, width):
+            image = TT.ResizeTransform(old_height, old_width, height, width).apply_image(image)
+        return image.permute(1, 2, 0).cpu().numpy()
+
     def save_image(
         self,
         image_path: Path,
+        xml_path: Path,
         original_image_shape: tuple[int, int],
         image_shape: tuple[int, int],
     ) -> Optional[dict[str, str]]:
@@ -372,6 +718,7 @@ class Preprocess:
 
         Args:
             image_path (Path): The path to the original image file.
+            xml_path (Path): The path to the PageXML file.
             image_stem (str): The stem of the image file name.
             original_image_shape (tuple[int, int]): The original shape of the image.
             image_shape (tuple[int, int]): The desired shape of the image.
@@ -395,40 +742,57 @@ class Preprocess:
 
         if copy_image:
             out_image_path = image_dir.joinpath(image_path.name)
+        elif self.keep_jpeg and image_path.suffix.lower() in [".jpg", ".jpeg"]:
+            # The source is already lossy, encoding as JPEG is a lot faster and smaller than PNG
+            out_image_path = image_dir.joinpath(image_path.name).with_suffix(".jpg")
         else:
             out_image_path = image_dir.joinpath(image_path.name).with_suffix(f".{save_method_image}")
 
         out_image_size_path = image_dir.joinpath(image_path.name).with_suffix(".size")
 
         # Check if image already exists and if it doesn't need resizing
-        if not self.overwrite and out_image_path.exists() and out_image_size_path.exists():
-            with out_image_size_path.open(mode="r") as f:
-                out_image_shape = tuple(int(x) for x in f.read().strip().split(","))
-            if out_image_shape == image_shape:
+        if not self.overwrite and self.output_exists(out_image_path) and self.output_exists(out_image_size_path):
+            if self.read_size(out_image_size_path) == image_shape:
                 return {"image_file_name": str(out_image_path.relative_to(self.output_dir))}
 
-        image_dir.mkdir(parents=True, exist_ok=True)
-
         if copy_image:
             copy_mode(image_path, out_image_path, mode="link")
+        elif self.use_gpu_decode(image_path):
+            image = self.load_resized_image_gpu(image_path, original_image_shape, image_shape)
+            self.save_array_to_path(image, out_image_path)
         else:
-            data = load_image_array_from_path(image_path)
+            # The fast resize only reads the image, so the copy to make it writable can be skipped
+            data = load_image_array_from_path(image_path, writable=not self._fast_resize)
             if data is None:
                 raise TypeError(f"Image {image_path} is None, loading failed")
-            aug_input = AugInput(
-                data["image"],
-                dpi=data["dpi"],
-                auto_dpi=self.auto_dpi,
-                default_dpi=self.default_dpi,
-                manual_dpi=self.manual_dpi,
-            )
-            transforms = T.AugmentationList(self.augmentations)(aug_input)
-            if aug_input.image is None:
-                raise ValueError(f"Image {image_path} is None after augmentation")
-            self.save_array_to_path(aug_input.image, out_image_path)
+            if self._fast_resize:
+                # Same result as the ResizeTransform, without the AugInput and transform dispatch overhead
+                old_height, old_width = data["image"].shape[:2]
+                if (old_height, old_width) == original_image_shape:
+                    # Use the shape computed from the header, so the image always matches the other outputs and the size file
+                    height, width = image_shape
+                else:
+                    # Rotated by its EXIF orientation, the header describes the stored (unrotated) image
+                    height, width = self.augmentations[0].get_output_shape(old_height, old_width, dpi=self.get_dpi(data["dpi"]))
+                image = data["image"]
+                if (old_height, old_width) != (height, width):
+                    # INTER_LINEAR also for exact halving, it is faster than pyrDown with cv2 on CPU and keeps the output identical
+                    image = cv2.resize(image, (width, height), interpolation=cv2.INTER_LINEAR)
+            else:
+                aug_input = AugInput(
+                    data["image"],
+                    dpi=data["dpi"],
+                    auto_dpi=self.auto_dpi,
+                    default_dpi=self.default_dpi,
+                    manual_dpi=self.manual_dpi,
+                )
+                transforms = T.AugmentationList(self.augmentations)(aug_input)
+                if aug_input.image is None:
+                    raise ValueError(f"Image {image_path} is None after augmentation")
+                image = aug_input.image
+            self.save_array_to_path(image, out_image_path)
 
-        with out_image_size_path.open(mode="w") as f:
-            f.write(f"{image_shape[0]},{image_shape[1]}")
+        self.write_size(out_image_size_path, image_shape)
 
         results = {"image_file_name": str(out_image_path.relative_to(self.output_dir))}
 
@@ -437,6 +801,7 @@ class Preprocess:
     def save_sem_seg(
         self,
         image_path: Path,
+        xml_path: Path,
         original_image_shape: tuple[int, int],
         image_shape: tuple[int, int],
     ) -> Optional[dict[str, str]]:
@@ -445,6 +810,7 @@ class Preprocess:
 
         Args:
             image_path (Path): The path to the image file.
+            xml_path (Path): The path to the PageXML file.
             image_stem (str): The stem of the image file name.
             original_image_shape (tuple[int, int]): The original shape of the image.
             image_shape (tuple[int, int]): The desired shape of the image.
@@ -459,8 +825,6 @@ class Preprocess:
         if self.output_dir is None:
             raise TypeError("Cannot run when the output dir is None")
 
-        xml_path = image_path_to_xml_path(image_path, self.disable_check)
-
         sem_seg_dir = self.output_dir.joinpath("sem_seg")
         save_method_sem_seg = self.output["sem_seg"]
 
@@ -468,22 +832,19 @@ class Preprocess:
         out_sem_seg_size_path = sem_seg_dir.joinpath(xml_path.name).with_suffix(".size")
 
         # Check if image already exists and if it doesn't need resizing
-        if not self.overwrite and out_sem_seg_path.exists() and out_sem_seg_size_path.exists():
-            with out_sem_seg_size_path.open(mode="r") as f:
-                out_sem_seg_shape = tuple(int(x) for x in f.read().strip().split(","))
-            if out_sem_seg_shape == image_shape:
+        if not self.overwrite and self.output_exists(out_sem_seg_path) and self.output_exists(out_sem_seg_size_path):
+            if self.read_size(out_sem_seg_size_path) == image_shape:
                 return {"sem_seg_file_name": str(out_sem_seg_path.relative_to(self.output_dir))}
 
-        converter = XMLToSemSeg(self.xml_regions, square_lines=self.square_lines)
+        converter = self._get_converter(XMLToSemSeg)
 
-        sem_seg = converter.convert(xml_path, original_image_shape=original_image_shape, image_shape=image_shape)
-
-        sem_seg_dir.mkdir(parents=True, exist_ok=True)
+        sem_seg = converter.convert(
+            self.load_page(xml_path), original_image_shape=original_image_shape, image_shape=image_shape
+        )
 
-        self.save_array_to_path(sem_seg, out_sem_seg_path)
+        self.save_array_to_path(sem_seg, out_sem_seg_path, label_mask=True)
 
-        with out_sem_seg_size_path.open(mode="w") as f:
-            f.write(f"{image_shape[0]},{image_shape[1]}")
+        self.write_size(out_sem_seg_size_path, image_shape)
 
         results = {"sem_seg_file_name": str(out_sem_seg_path.relative_to(self.output_dir))}
 
@@ -492,6 +853,7 @@ class Preprocess:
     def save_instances(
         self,
         image_path: Path,
+        xml_path: Path,
         original_image_shape: tuple[int, int],
         image_shape: tuple[int, int],
     ) -> Optional[dict[str, str]]:
@@ -500,6 +862,7 @@ class Preprocess:
 
         Args:
             image_path (Path): The path to the image file.
+            xml_path (Path): The path to the PageXML file.
             original_image_shape (tuple[int, int]): The original shape of the image.
             image_shape (tuple[int, int]): The desired shape of the image.
 
@@ -513,8 +876,6 @@ class Preprocess:
         if self.output_dir is None:
             raise ValueError("Cannot run when the output dir is not set")
 
-        xml_path = image_path_to_xml_path(image_path, self.disable_check)
-
         instances_dir = self.output_dir.joinpath("instances")
         save_method_instances = self.output["instances"]
 
@@ -522,22 +883,18 @@ class Preprocess:
         out_instances_size_path = instances_dir.joinpath(xml_path.name).with_suffix(".size")
 
         # Check if image already exists and if it doesn't need resizing
-        if not self.overwrite and out_instances_path.exists() and out_instances_size_path.exists():
-            with out_instances_size_path.open(mode="r") as f:
-                out_intstances_shape = tuple(int(x) for x in f.read().strip().split(","))
-            if out_intstances_shape == image_shape:
+        if not self.overwrite and self.output_exists(out_instances_path) and self.output_exists(out_instances_size_path):
+            if self.read_size(out_instances_size_path) == image_shape:
                 return {"annotations": str(out_instances_path.relative_to(self.output_dir))}
 
-        converter = XMLToInstances(self.xml_regions, square_lines=self.square_lines)
+        converter = self._get_converter(XMLToInstances)
 
-        instances = converter.convert(xml_path, original_image_shape=original_image_shape, image_shape=image_shape)
-
-        instances_dir.mkdir(parents=True, exist_ok=True)
+        instances = converter.convert(
+            self.load_page(xml_path), original_image_shape=original_image_shape, image_shape=image_shape
+        )
 
-        with out_instances_path.open(mode="w") as f:
-            json.dump(instances, f)
-        with out_instances_size_path.open(mode="w") as f:
-            f.write(f"{image_shape[0]},{image_shape[1]}")
+        save_json_to_path(instances, out_instances_path)
+        self.write_size(out_instances_size_path, image_shape)
 
         results = {"annotations": str(out_instances_path.relative_to(self.output_dir))}
 
@@ -546,6 +903,7 @@ class Preprocess:
     def save_pano(
         self,
         image_path: Path,
+        xml_path: Path,
         original_image_shape: tuple[int, int],
         image_shape: tuple[int, int],
     ) -> Optional[dict[str, str]]:
@@ -554,6 +912,7 @@ class Preprocess:
 
         Args:
             image_path (Path): The path to the image file.
+            xml_path (Path): The path to the PageXML file.
             original_image_shape (tuple[int, int]): The original shape of the image.
             image_shape (tuple[int, int]): The desired shape of the image.
 
@@ -567,8 +926,6 @@ class Preprocess:
         if self.output_dir is None:
             raise TypeError("Cannot run when the output dir is None")
 
-        xml_path = image_path_to_xml_path(image_path, self.disable_check)
-
         pano_dir = self.output_dir.joinpath("pano")
         save_method_pano = self.output["pano"]
 
@@ -577,29 +934,30 @@ class Preprocess:
         out_segments_info_path = pano_dir.joinpath(xml_path.name).with_suffix(".json")
 
         # Check if image already exists and if it doesn't need resizing
-        if not self.overwrite and out_pano_path.exists() and out_segments_info_path.exists() and out_pano_size_path.exists():
-            with out_pano_size_path.open(mode="r") as f:
-                out_pano_shape = tuple(int(x) for x in f.read().strip().split(","))
-            if out_pano_shape == image_shape:
+        if (
+            not self.overwrite
+            and self.output_exists(out_pano_path)
+            and self.output_exists(out_segments_info_path)
+            and self.output_exists(out_pano_size_path)
+        ):
+            if self.read_size(out_pano_size_path) == image_shape:
                 return {
                     "pano_file_name": str(out_pano_path.relative_to(self.output_dir)),
                     "segments_info": str(out_segments_info_path.relative_to(self.output_dir)),
                 }
 
-        converter = XMLToPano(self.xml_regions, square_lines=self.square_lines)
+        converter = self._get_converter(XMLToPano)
 
-        pano_output = converter.convert(xml_path, original_image_shape=original_image_shape, image_shape=image_shape)
+        pano_output = converter.convert(
+            self.load_page(xml_path), original_image_shape=original_image_shape, image_shape=image_shape
+        )
         pano, segments_info = pano_output
 
-        pano_dir.mkdir(parents=True, exist_ok=True)
-
-        self.save_array_to_path(pano, out_pano_path)
+        self.save_array_to_path(pano, out_pano_path, label_mask=True)
 
-        with out_pano_size_path.open(mode="w") as f:
-            f.write(f"{image_shape[0]},{image_shape[1]}")
+        self.write_size(out_pano_size_path, image_shape)
 
-        with out_segments_info_path.open(mode="w") as f:
-            json.dump(segments_info, f)
+        save_json_to_path(segments_info, out_segments_info_path)
 
         results = {
             "pano_file_name": str(out_pano_path.relative_to(self.output_dir)),
@@ -611,6 +969,7 @@ class Preprocess:
     def save_binary_seg(
         self,
         image_path: Path,
+        xml_path: Path,
         original_image_shape: tuple[int, int],
         image_shape: tuple[int, int],
     ) -> Optional[dict[str, str]]:
@@ -619,6 +978,7 @@ class Preprocess:
 
         Args:
             image_path (Path): The path to the image file.
+            xml_path (Path): The path to the PageXML file.
             image_stem (str): The stem of the image file name.
             original_image_shape (tuple[int, int]): The original shape of the image.
             image_shape (tuple[int, int]): The desired shape of the image.
@@ -633,8 +993,6 @@ class Preprocess:
         if self.output_dir is None:
             raise TypeError("Cannot run when the output dir is None")
 
-        xml_path = image_path_to_xml_path(image_path, self.disable_check)
-
         binary_seg_dir = self.output_dir.joinpath("binary_seg")
         save_method_binary_seg = self.output["binary_seg"]
 
@@ -642,54 +1000,51 @@ class Preprocess:
         out_binary_seg_size_path = binary_seg_dir.joinpath(xml_path.name).with_suffix(".size")
 
         # Check if image already exists and if it doesn't need resizing
-        if not self.overwrite and out_binary_seg_path.exists() and out_binary_seg_size_path.exists():
-            with out_binary_seg_size_path.open(mode="r") as f:
-                out_binary_seg_shape = tuple(int(x) for x in f.read().strip().split(","))
-            if out_binary_seg_shape == image_shape:
+        if not self.overwrite and self.output_exists(out_binary_seg_path) and self.output_exists(out_binary_seg_size_path):
+            if self.read_size(out_binary_seg_size_path) == image_shape:
                 return {"binary_seg_file_name": str(out_binary_seg_path.relative_to(self.output_dir))}
-        converter = XMLToBinarySeg(self.xml_regions, square_lines=self.square_lines)
+        converter = self._get_converter(XMLToBinarySeg)
 
-        binary_seg = converter.convert(xml_path, original_image_shape=original_image_shape, image_shape=image_shape)
-
-        binary_seg_dir.mkdir(parents=True, exist_ok=True)
+        binary_seg = converter.convert(
+            self.load_page(xml_path), original_image_shape=original_image_shape, image_shape=image_shape
+        )
 
-        self.save_array_to_path(binary_seg, out_binary_seg_path)
+        self.save_array_to_path(binary_seg, out_binary_seg_path, label_mask=True)
 
-        with out_binary_seg_size_path.open(mode="w") as f:
-            f.write(f"{image_shape[0]},{image_shape[1]}")
+        self.write_size(out_binary_seg_size_path, image_shape)
 
         results = {"binary_seg_file_name": str(out_binary_seg_path.relative_to(self.output_dir))}
 
         return results
 
-    def get_dpi(self, image_path: Path) -> Optional[int]:
+    def get_dpi(self, image_dpi: Optional[int]) -> Optional[int]:
         """
-        Get the DPI of an image.
+        Get the DPI used for resizing an image.
+        Only a resize with a target DPI (ResizeScaling with target_dpi) uses it, the image is not scaled for its DPI when it is None.
+
+        With auto_dpi the DPI is read from the image header, the same way PIL does. For a JPEG without JFIF density but with EXIF data
+        that has no resolution tags, this is the 72 DPI default of PIL and not default_dpi.
 
         Args:
-            image_path (Path): The path to the image file.
+            image_dpi (Optional[int]): The DPI read from the image header, None if not set.
 
         Returns:
-            int: The DPI of the image.
+            Optional[int]: The DPI of the image.
 
         """
         if self.auto_dpi:
-            original_image_dpi = imagesize.getDPI(image_path)
-            if original_image_dpi == (-1, -1):
+            if image_dpi is None:
                 return self.default_dpi
+            return image_dpi
+        return self.manual_dpi
 
-            assert len(original_image_dpi) == 2, f"Invalid DPI: {original_image_dpi}"
-            assert original_image_dpi[0] == original_image_dpi[1], f"Non-square DPI: {original_image_dpi}"
-            original_image_dpi = original_image_dpi[0]
-        else:
-            original_image_dpi = self.manual_dpi
-
-    def process_single_file(self, image_path: Path) -> dict:
+    def process_single_file(self, image_path: Path, xml_path: Optional[Path] = None) -> dict:
         """
         Process a single image and PageXML to be used during training
 
         Args:
             image_path (Path): Path to input image
+            xml_path (Optional[Path], optional): Path to the corresponding PageXML, derived from the image path if not given. Defaults to None.
 
         Raises:
             TypeError: Cannot return if output dir is not set
@@ -703,9 +1058,15 @@ class Preprocess:
 
         image_stem = image_path.stem
 
-        _original_image_shape = imagesize.get(image_path)
-        original_image_shape = int(_original_image_shape[1]), int(_original_image_shape[0])
-        original_image_dpi = self.get_dpi(image_path)
+        if not self._output_dirs_created:
+            self.create_output_dirs()
+
+        if xml_path is None:
+            xml_path = image_path_to_xml_path(image_path, check=not self.disable_check)
+
+        # Shape and DPI are read together, so the image header is only parsed once
+        original_image_shape, image_dpi = read_image_header(image_path)
+        original_image_dpi = self.get_dpi(image_dpi)
         image_shape = self.augmentations[0].get_output_shape(
             original_image_shape[0], original_image_shape[1], dpi=original_image_dpi
         )
@@ -713,13 +1074,33 @@ class Preprocess:
         results = {}
         results["original_file_name"] = str(image_path)
 
-        for output in self.output:
-            if hasattr(self, f"save_{output}"):
-                output_result = getattr(self, f"save_{output}")(image_path, original_image_shape, image_shape)
-                if output_result is not None:
-                    results.update(output_result)
-            else:
-                raise NotImplementedError(f"Output {output} not implemented")
+        # Encoding the images is done in separate threads, while the next XML conversion is running
+        save_futures: list[Future] = []
+        size_writes: list[tuple[Path, tuple[int, int]]] = []
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            self._save_executor = executor
+            self._save_futures = save_futures
+            self._size_writes = size_writes
+            try:
+                for output in self.output:
+                    if hasattr(self, f"save_{output}"):
+                        output_result = getattr(self, f"save_{output}")(image_path, xml_path, original_image_shape, image_shape)
+                        if output_result is not None:
+                            results.update(output_result)
+                    else:
+                        raise NotImplementedError(f"Output {output} not implemented")
+            finally:
+                self._save_executor = None
+                self._save_futures = []
+                self._size_writes = []
+                self._current_page = None
+
+            # Raise any exception that occurred while saving
+            for future in as_completed(save_futures):
+                future.result()
+
+        for size_path, shape in size_writes:
+            self.write_size(size_path, shape)
 
         return results
 
@@ -738,7 +1119,7 @@ class Preprocess:
         if self.output_dir is None:
             raise TypeError("Cannot run when the output dir is None")
 
-        xml_paths = [image_path_to_xml_path(image_path, self.disable_check) for image_path in self.input_paths]
+        xml_paths = [image_path_to_xml_path(image_path, check=False) for image_path in self.input_paths]
 
         if len(self.input_paths) == 0:
             raise ValueError(f"No images found when checking input ({self.input_paths})")
@@ -761,45 +1142,70 @@ class Preprocess:
         with mode_path.open(mode="w") as f:
             f.write(self.xml_regions.mode)
 
+        self.create_output_dirs()
+
+        if not self.overwrite:
+            self._existing_outputs = self.scan_existing_outputs()
+
         # Single thread
         # results = []
         # for image_path in tqdm(image_paths, desc="Preprocessing"):
         #     results.append(self.process_single_file(image_path))
 
         # Multithread
-        with Pool(os.cpu_count()) as pool:
-            results = list(
-                tqdm(
-                    iterable=pool.imap_unordered(self.process_single_file, self.input_paths),
-                    total=len(self.input_paths),
-                    desc="Preprocessing",
-                )
-            )
-
-        # Assuming all key are the same make one dict
-        results = {
-            "data": list_of_dict_to_dict_of_list(results),
-            "classes": self.xml_regions.regions,
-            "mode": self.xml_regions.mode,
-        }
-
-        output_path = self.output_dir.joinpath("info.json")
-        with output_path.open(mode="w") as f:
-            json.dump(results, f)
-
-
-def list_of_dict_to_dict_of_list(input_list: list[dict[str, Any]]) -> dict[str, list[Any]]:
-    """
-    Convert a list of dicts into dict of lists. All dicts much have the same keys. The output number of dicts matches the length of the list
-
-    Args:
-        input_list (list[dict[str, Any]]): list of dicts
+        n_workers = os.cpu_count() or 1
+        # Send multiple files per task to reduce the IPC overhead for fast files
+        chunksize = max(1, len(self.input_paths) // (n_workers * 4))
+        # Pickle once in the main process, workers rebuild the instance (and their converters) from these bytes
+        preprocess_bytes = pickle.dumps(self)
+        # Results are streamed to disk as they come in, one file per key, so they are never all in memory at once
+        # The temporary directory is removed even when the run fails
+        with tempfile.TemporaryDirectory(dir=self.output_dir) as tmp_dir:
+            key_paths: dict[str, Path] = {}
+            key_files: dict[str, BinaryIO] = {}
+            try:
+                with Pool(n_workers, initializer=_init_worker, initargs=(preprocess_bytes,)) as pool:
+                    for result in tqdm(
+                        iterable=pool.imap_unordered(_worker_process, zip(self.input_paths, xml_paths), chunksize=chunksize),
+                        total=len(self.input_paths),
+                        desc="Preprocessing",
+                    ):
+                        if not key_files:
+                            # Assuming all key are the same, take the keys from the first result
+                            key_paths = {key: Path(tmp_dir).joinpath(f"{i}.json") for i, key in enumerate(result.keys())}
+                            key_files = {key: key_path.open(mode="wb") for key, key_path in key_paths.items()}
+                        else:
+                            for key_file in key_files.values():
+                                key_file.write(b", ")
+                        for key, key_file in key_files.items():
+                            key_file.write(json_dumps(result[key]))
+            finally:
+                for key_file in key_files.values():
+                    key_file.close()
+
+            output_path = self.output_dir.joinpath("info.json")
+            self.save_info(key_paths, output_path)
+
+    def save_info(self, key_paths: dict[str, Path], output_path: Path) -> None:
+        """
+        Combine the streamed per key results to the info.json of the dataset.
+        Each key file already holds the comma separated JSON values of that key, so it is copied without parsing it again.
 
-    Returns:
-        dict[str, list[Any]]: dict of lists
-    """
-    output_dict = {key: [item[key] for item in input_list] for key in input_list[0].keys()}
-    return output_dict
+        Args:
+            key_paths (dict[str, Path]): path to the file with the values of all files for each key
+            output_path (Path): path to the info.json
+        """
+        with output_path.open(mode="wb") as f:
+            f.write(b'{"data": {')
+            for i, (key, key_path) in enumerate(key_paths.items()):
+                if i > 0:
+                    f.write(b", ")
+                f.write(json_dumps(key) + b": [")
+                with key_path.open(mode="rb") as key_file:
+                    shutil.copyfileobj(key_file, f)
+                f.write(b"]")
+            f.write(b'}, "classes": ' + json_dumps(self.xml_regions.regions))
+            f.write(b', "mode": ' + json_dumps(self.xml_regions.mode) + b"}")
 
 
 def main(args) -> None:
@@ -840,6 +1246,8 @@ def main(args) -> None:
         auto_dpi=args.auto_dpi,
         default_dpi=args.default_dpi,
         manual_dpi=args.manual_dpi,
+        keep_jpeg=args.keep_jpeg,
+        gpu_decode=args.gpu_decode,
     )
     process.run()
 
@@ -264,6 +264,7 @@ class PageXMLEditor(PageXML):
         ET.register_namespace("", self.XMLNS["xmlns"])
 
         self.filepath = Path(filepath) if filepath is not None else None
+        self.size: Optional[tuple[int, int]] = None
         if self.filepath is not None:
             if self.filepath.exists():
                 self.parse(self.filepath)
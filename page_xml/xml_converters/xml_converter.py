@@ -1,12 +1,18 @@
 import argparse
+import functools
 import logging
+import os
+import pickle
 import sys
+import threading
+from multiprocessing.pool import Pool
 from pathlib import Path
-from typing import Any, Optional
+from typing import Any, Iterator, Optional, Sequence
 
 import cv2
 import numpy as np
 from detectron2.config import CfgNode, configurable
+from tqdm import tqdm
 
 sys.path.append(str(Path(__file__).resolve().parent.joinpath("..")))
 from page_xml.page_xml_editor import PageXMLEditor
@@ -19,8 +25,9 @@ from utils.vector_utils import point_at_start_or_end_assignment
 def get_arguments() -> argparse.Namespace:
     parser = argparse.ArgumentParser(parents=[XMLRegions.get_parser()], description="Code to turn an xml file into an array")
     io_args = parser.add_argument_group("IO")
-    io_args.add_argument("-i", "--input", help="Input file", required=True, type=str)
-    io_args.add_argument("-o", "--output", help="Output file", required=True, type=str)
+    io_args.add_argument("-i", "--input", help="Input file, or dir of xml files", required=True, type=str)
+    io_args.add_argument("-o", "--output", help="Output file, or output dir when the input is a dir", required=True, type=str)
+    io_args.add_argument("-w", "--workers", help="Number of workers to use when the input is a dir", type=int, default=None)
 
     xml_converter_args = parser.add_argument_group("XML Converter")
     xml_converter_args.add_argument("--square-lines", help="Square the lines", action="store_true")
@@ -29,7 +36,128 @@ def get_arguments() -> argparse.Namespace:
     return args
 
 
+# Scratch buffers of the current thread, reused between pages to avoid allocating (and page faulting) a new mask per line
+_SCRATCH = threading.local()
+
+
+def get_scratch(name: str, shape: tuple[int, ...], dtype: Any) -> np.ndarray:
+    """
+    Get a zeroed scratch array for intermediate results. The underlying buffer grows lazily to the largest size requested and is never shrunk.
+    The returned array is only valid until the next call with the same name, so it should never be returned to the caller of a converter.
+
+    Args:
+        name (str): name of the buffer, different intermediate results should use different names
+        shape (tuple[int, ...]): shape of the requested array
+        dtype (Any): dtype of the requested array
+
+    Returns:
+        np.ndarray: contiguous zeroed array of the requested shape and dtype
+    """
+    buffers: Optional[dict[tuple[str, str], np.ndarray]] = getattr(_SCRATCH, "buffers", None)
+    if buffers is None:
+        buffers = {}
+        _SCRATCH.buffers = buffers
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    key = (name, dtype.str)
+    buffer = buffers.get(key)
+    if buffer is None or buffer.size < size:
+        buffer = np.empty(size, dtype=dtype)
+        buffers[key] = buffer
+    # Take a flat prefix instead of slicing a larger 2D buffer, so the result stays contiguous for OpenCV
+    scratch = buffer[:size].reshape(shape)
+    scratch.fill(0)
+    return scratch
+
+
+def reset_scratch() -> None:
+    """
+    Drop all scratch buffers of the current process, for example when starting a new worker
+    """
+    global _SCRATCH
+    _SCRATCH = threading.local()
+
+
+# Maximum number of threads a single conversion may use, worker processes of a pool set this to 1 so they do not oversubscribe the CPU
+_DRAW_THREADS = os.cpu_count() or 1
+
+
+def set_draw_threads(num_threads: int) -> None:
+    """
+    Set the maximum number of threads a single conversion in the current process may use
+
+    Args:
+        num_threads (int): maximum number of threads, 1 disables threading
+    """
+    global _DRAW_THREADS
+    _DRAW_THREADS = max(1, num_threads)
+
+
+def get_draw_threads() -> int:
+    """
+    Get the maximum number of threads a single conversion in the current process may use
+
+    Returns:
+        int: maximum number of threads
+    """
+    return _DRAW_THREADS
+
+
 # IDEA have fixed ordering of the classes, maybe look at what order is best
+# Converter of the current worker process, set by the initializer of the pool used in convert_many
+_CONVERTER: Optional["_XMLConverter"] = None
+
+
+def _init_convert_worker(converter_bytes: bytes) -> None:
+    """
+    Initialize a worker process of the conversion pool, so the converter is only sent once per worker
+
+    Args:
+        converter_bytes (bytes): pickled converter
+    """
+    global _CONVERTER
+    _CONVERTER = pickle.loads(converter_bytes)
+    reset_scratch()
+    # The pool already runs a conversion per core
+    set_draw_threads(1)
+
+
+def _convert_worker(args: tuple[Path, Optional[tuple[int, int]], Optional[tuple[int, int]]]) -> tuple[Path, Any]:
+    """
+    Convert a single PageXML using the converter of the current worker
+
+    Args:
+        args (tuple[Path, Optional[tuple[int, int]], Optional[tuple[int, int]]]): xml path, original image shape and image shape
+
+    Raises:
+        TypeError: the worker has not been initialized
+
+    Returns:
+        tuple[Path, Any]: the xml path and the converted output
+    """
+    if _CONVERTER is None:
+        raise TypeError("Worker has not been initialized")
+    xml_path, original_image_shape, image_shape = args
+    return xml_path, _CONVERTER.convert(xml_path, original_image_shape=original_image_shape, image_shape=image_shape)
+
+
+def _convert_to_file_worker(paths: tuple[Path, Path]) -> None:
+    """
+    Convert a single PageXML using the converter of the current worker and save the result, so the array is not sent back
+
+    Args:
+        paths (tuple[Path, Path]): xml path and output path
+
+    Raises:
+        TypeError: the worker has not been initialized
+    """
+    if _CONVERTER is None:
+        raise TypeError("Worker has not been initialized")
+    xml_path, output_path = paths
+    output = _CONVERTER.convert(xml_path, original_image_shape=None, image_shape=None)
+    save_image_array_to_path(output_path, output)
+
+
 class _XMLConverter:
     """
     Base class for converting xml files to other formats, add new converters by subclassing this class and adding a build_{mode} function
@@ -51,6 +179,19 @@ class _XMLConverter:
         self.logger = logging.getLogger(get_logger_name())
         self.xml_regions = xml_regions
         self.square_lines = square_lines
+        # The mode does not change, so look up the build function once instead of on every conversion
+        self._build_fn = getattr(self, f"build_{self.xml_regions.mode}", None)
+
+    @functools.cached_property
+    def _unique_region_types(self) -> tuple[str, ...]:
+        """
+        The unique element types of the regions, collected once instead of on every conversion.
+        Computed on first use, as the region types are only defined for the region based modes.
+
+        Returns:
+            tuple[str, ...]: the unique element types
+        """
+        return tuple(set(self.xml_regions.region_types.values()))
 
     @classmethod
     def from_config(cls, cfg: CfgNode) -> dict[str, Any]:
@@ -71,7 +212,7 @@ class _XMLConverter:
 
     def convert(
         self,
-        xml_path: Path,
+        xml_path: Path | PageXMLEditor,
         original_image_shape: Optional[tuple[int, int]] = None,
         image_shape: Optional[tuple[int, int]] = None,
     ) -> Any:
@@ -79,7 +220,7 @@ class _XMLConverter:
         Turn a single PageXML into a dict with scaled coordinates
 
         Args:
-            xml_path (Path): Path to PageXML
+            xml_path (Path | PageXMLEditor): Path to PageXML, or an already parsed PageXML so it can be shared between converters
             original_image_shape (Optional[tuple[int, int]], optional): Shape of the original image. Defaults to None.
             image_shape (Optional[tuple[int, int]], optional): Shape of the output image. Defaults to None.
 
@@ -89,7 +230,7 @@ class _XMLConverter:
         Returns:
             Optional[dict]: scaled coordinates about the location of the objects in the image
         """
-        gt_data = PageXMLEditor(xml_path)
+        gt_data = xml_path if isinstance(xml_path, PageXMLEditor) else PageXMLEditor(xml_path)
 
         if original_image_shape is not None:
             gt_data.set_size(original_image_shape)
@@ -97,15 +238,54 @@ class _XMLConverter:
         if image_shape is None:
             image_shape = gt_data.get_size()
 
-        if hasattr(self, f"build_{self.xml_regions.mode}"):
-            output = getattr(self, f"build_{self.xml_regions.mode}")(
-                gt_data,
-                image_shape,
-            )
-            return output
-        else:
+        if self._build_fn is None:
             raise NotImplementedError(f"Mode {self.xml_regions.mode} is not known")
 
+        output = self._build_fn(
+            gt_data,
+            image_shape,
+        )
+        return output
+
+    def convert_many(
+        self,
+        xml_paths: Sequence[Path],
+        original_image_shapes: Optional[Sequence[Optional[tuple[int, int]]]] = None,
+        image_shapes: Optional[Sequence[Optional[tuple[int, int]]]] = None,
+        workers: Optional[int] = None,
+    ) -> Iterator[tuple[Path, Any]]:
+        """
+        Turn multiple PageXMLs into their converted output, spreading the pages over multiple processes
+
+        Args:
+            xml_paths (Sequence[Path]): Paths to the PageXMLs
+            original_image_shapes (Optional[Sequence[Optional[tuple[int, int]]]], optional): Shapes of the original images. Defaults to None.
+            image_shapes (Optional[Sequence[Optional[tuple[int, int]]]], optional): Shapes of the output images. Defaults to None.
+            workers (Optional[int], optional): Number of worker processes, uses all cores when None. Defaults to None.
+
+        Raises:
+            ValueError: the number of shapes does not match the number of paths
+
+        Yields:
+            Iterator[tuple[Path, Any]]: the xml path and the converted output, in the order of the given paths
+        """
+        if original_image_shapes is None:
+            original_image_shapes = [None] * len(xml_paths)
+        if image_shapes is None:
+            image_shapes = [None] * len(xml_paths)
+        if len(original_image_shapes) != len(xml_paths) or len(image_shapes) != len(xml_paths):
+            raise ValueError(
+                f"Number of shapes ({len(original_image_shapes)}, {len(image_shapes)}) does not match the number of paths ({len(xml_paths)})"
+            )
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+        chunksize = max(1, len(xml_paths) // (4 * workers))
+        # Pickle once, workers rebuild the converter from these bytes instead of receiving it with every page
+        converter_bytes = pickle.dumps(self)
+        with Pool(workers, initializer=_init_convert_worker, initargs=(converter_bytes,)) as pool:
+            yield from pool.imap(_convert_worker, zip(xml_paths, original_image_shapes, image_shapes), chunksize=chunksize)
+
     @staticmethod
     def _scale_coords(coords: np.ndarray, out_size: tuple[int, int], size: tuple[int, int]) -> np.ndarray:
         """
@@ -119,10 +299,148 @@ class _XMLConverter:
         Returns:
             np.ndarray: the scaled coordinates
         """
-        scale_factor = (np.asarray(out_size) - 1) / (np.asarray(size) - 1)
-        scaled_coords = (coords * scale_factor[::-1]).astype(np.float32)
+        scaled_coords = (coords * _XMLConverter._scale_factor(tuple(out_size), tuple(size))).astype(np.float32)
         return scaled_coords
 
+    @staticmethod
+    def _scale_round_coords(coords: np.ndarray, out_size: tuple[int, int], size: tuple[int, int]) -> np.ndarray:
+        """
+        Scale coordinates to a new size and round them to pixel coordinates, reusing a single intermediate array
+
+        Args:
+            coords (np.ndarray): the coordinates to scale
+            out_size (tuple[int, int]): the size of the output image
+            size (tuple[int, int]): the size of the input image
+
+        Returns:
+            np.ndarray: the scaled and rounded coordinates
+        """
+        # Same result as rounding the output of _scale_coords: multiplied in float64 and stored as float32 before rounding
+        scaled_coords = np.empty(coords.shape, dtype=np.float32)
+        np.multiply(coords, _XMLConverter._scale_factor(tuple(out_size), tuple(size)), out=scaled_coords, casting="same_kind")
+        np.rint(scaled_coords, out=scaled_coords)
+        return scaled_coords.astype(np.int32)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=16)
+    def _scale_factor(out_size: tuple[int, int], size: tuple[int, int]) -> np.ndarray:
+        """
+        Get the (x, y) scale factor between two sizes, cached as it is the same for all elements of a page
+
+        Args:
+            out_size (tuple[int, int]): the size of the output image
+            size (tuple[int, int]): the size of the input image
+
+        Returns:
+            np.ndarray: the read-only scale factor in (x, y) order
+        """
+        scale_factor = ((np.asarray(out_size) - 1) / (np.asarray(size) - 1))[::-1].copy()
+        scale_factor.setflags(write=False)
+        return scale_factor
+
+    @classmethod
+    def _scale_round_coords_batch(
+        cls, coords_list: list[np.ndarray], out_size: tuple[int, int], size: tuple[int, int]
+    ) -> list[np.ndarray]:
+        """
+        Scale and round the coordinates of all elements of a page in a single pass
+
+        Args:
+            coords_list (list[np.ndarray]): the coordinates of each element
+            out_size (tuple[int, int]): the size of the output image
+            size (tuple[int, int]): the size of the input image
+
+        Returns:
+            list[np.ndarray]: the scaled and rounded coordinates of each element
+        """
+        if len(coords_list) == 0:
+            return []
+        offsets = np.cumsum([len(coords) for coords in coords_list])[:-1]
+        flat_coords = np.concatenate(coords_list, axis=0)
+        rounded_coords = cls._scale_round_coords(flat_coords, out_size, size)
+        return np.split(rounded_coords, offsets)
+
+    @classmethod
+    def _scale_round_endpoints(
+        cls, coords_list: list[np.ndarray], out_size: tuple[int, int], size: tuple[int, int]
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Scale and round only the start and end points of all lines of a page in a single pass
+
+        Args:
+            coords_list (list[np.ndarray]): the coordinates of each line
+            out_size (tuple[int, int]): the size of the output image
+            size (tuple[int, int]): the size of the input image
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: the scaled and rounded start points and end points of the lines
+        """
+        if len(coords_list) == 0:
+            empty = np.empty((0, 2), dtype=np.int32)
+            return empty, empty
+        endpoints = np.stack([coords[[0, -1]] for coords in coords_list], axis=0)
+        rounded_endpoints = cls._scale_round_coords(endpoints, out_size, size)
+        return rounded_endpoints[:, 0], rounded_endpoints[:, 1]
+
+    @staticmethod
+    def _line_roi(rounded_coords: np.ndarray, out_size: tuple[int, int], thickness: int) -> Optional[tuple[int, int, int, int]]:
+        """
+        Get the region of the output image that can be covered by a line, so the line can be drawn in a mask of only that region
+
+        Args:
+            rounded_coords (np.ndarray): the rounded coordinates of the line
+            out_size (tuple[int, int]): the size of the output image
+            thickness (int): thickness of the line
+
+        Returns:
+            Optional[tuple[int, int, int, int]]: min x, min y, max x and max y of the region, None if the line is outside the image
+        """
+        margin = thickness + 1
+        min_x, min_y = np.maximum(rounded_coords.min(axis=0) - margin, 0)
+        max_x = min(rounded_coords[:, 0].max() + margin, out_size[1] - 1)
+        max_y = min(rounded_coords[:, 1].max() + margin, out_size[0] - 1)
+        if min_x > max_x or min_y > max_y:
+            return None
+        return int(min_x), int(min_y), int(max_x), int(max_y)
+
+    @staticmethod
+    def _count_line_pixels(rounded_coords: np.ndarray, out_size: tuple[int, int], thickness: int) -> int:
+        """
+        Count the pixels of a single line, by drawing it in a scratch mask covering only the bounding box of the line
+
+        Args:
+            rounded_coords (np.ndarray): the rounded coordinates of the line
+            out_size (tuple[int, int]): the size of the output image
+            thickness (int): thickness of the line
+
+        Returns:
+            int: the number of pixels of the line that fall within the output image
+        """
+        roi = _XMLConverter._line_roi(rounded_coords, out_size, thickness)
+        if roi is None:
+            return 0
+        min_x, min_y, max_x, max_y = roi
+        mask = get_scratch("count_line_pixels", (max_y - min_y + 1, max_x - min_x + 1), np.uint8)
+        cv2.polylines(mask, [(rounded_coords - (min_x, min_y)).astype(np.int32).reshape(-1, 1, 2)], False, (1,), thickness)
+        return cv2.countNonZero(mask)
+
+    def _lines_overlap(self, all_rounded_coords: list[np.ndarray], image: np.ndarray, thickness: int) -> bool:
+        """
+        Check if any of the lines drawn (with non zero colors) on an image overlap, without drawing the lines one by one on the full image.
+        Lines overlap when the sum of the pixels of the separate lines is larger than the number of pixels drawn.
+
+        Args:
+            all_rounded_coords (list[np.ndarray]): the rounded coordinates of all lines drawn on the image
+            image (np.ndarray): the image with only these lines drawn
+            thickness (int): thickness of the lines
+
+        Returns:
+            bool: True if at least two lines share a pixel
+        """
+        out_size = image.shape[:2]
+        total_line_pixels = sum(self._count_line_pixels(coords, out_size, thickness) for coords in all_rounded_coords)
+        return total_line_pixels > np.count_nonzero(image)
+
     @staticmethod
     def _bounding_box(array: np.ndarray) -> list[float]:
         """
@@ -134,10 +452,47 @@ class _XMLConverter:
         Returns:
             list[float]: bounding box of the array
         """
-        min_x, min_y = np.min(array, axis=0)
-        max_x, max_y = np.max(array, axis=0)
-        bbox = np.asarray([min_x, min_y, max_x, max_y]).astype(np.float32).tolist()
-        return bbox
+        # Reduce directly into a single output buffer, instead of building a new array from the separate scalars
+        bbox = np.empty(4, dtype=np.float32)
+        np.min(array, axis=0, out=bbox[:2])
+        np.max(array, axis=0, out=bbox[2:])
+        return bbox.tolist()
+
+    def _line_pixel_coords(
+        self, rounded_coords: np.ndarray, out_size: tuple[int, int], thickness: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Get the pixels covered by a line, when squaring the lines the pixels beyond the start and end are left out
+
+        Args:
+            rounded_coords (np.ndarray): the rounded coordinates of the line
+            out_size (tuple[int, int]): the size of the output image
+            thickness (int): thickness of the line
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: the y and x coordinates of the pixels of the line, in row-major order
+        """
+        roi = self._line_roi(rounded_coords, out_size, thickness)
+        if roi is None:
+            empty = np.empty(0, dtype=np.intp)
+            return empty, empty
+        min_x, min_y, max_x, max_y = roi
+
+        # Only draw and scan the region around the line, instead of the full image
+        binary_mask = get_scratch("line_pixel_coords", (max_y - min_y + 1, max_x - min_x + 1), np.uint8)
+        cv2.polylines(
+            binary_mask, [(rounded_coords - (min_x, min_y)).astype(np.int32).reshape(-1, 1, 2)], False, (1,), thickness
+        )
+        ys, xs = np.nonzero(binary_mask)
+        ys += min_y
+        xs += min_x
+
+        if self.square_lines:
+            start_or_end = point_at_start_or_end_assignment(rounded_coords, xs, ys)
+            keep = np.logical_not(start_or_end)
+            ys, xs = ys[keep], xs[keep]
+
+        return ys, xs
 
     def draw_line(
         self,
@@ -147,7 +502,7 @@ class _XMLConverter:
         thickness: int = 1,
     ) -> tuple[np.ndarray, bool]:
         """
-        Draw lines on an image
+        Draw lines on an image, the image is modified in place
 
         Args:
             image (np.ndarray): image to draw on
@@ -155,29 +510,28 @@ class _XMLConverter:
             color (int | tuple[int] | tuple[int, int, int]): color of the lines
             thickness (int, optional): thickness of the lines. Defaults to 1.
         """
-        temp_image = np.zeros_like(image)
-        if isinstance(color, tuple) and len(color) == 3 and temp_image.ndim == 2:
+        if isinstance(color, tuple) and len(color) == 3 and image.ndim == 2:
             raise ValueError("Color should be a single int")
 
-        binary_mask = np.zeros(image.shape[:2], dtype=np.uint8)
-
-        rounded_coords = np.round(coords).astype(np.int32)
+        # Callers often pass coordinates that are already rounded, these only need a (no-op) cast
+        if np.issubdtype(coords.dtype, np.integer):
+            rounded_coords = coords.astype(np.int32, copy=False)
+        else:
+            rounded_coords = np.rint(coords).astype(np.int32)
 
         color = (color,) if isinstance(color, int) else color
 
-        if self.square_lines:
-            cv2.polylines(binary_mask, [rounded_coords.reshape(-1, 1, 2)], False, (1,), thickness)
-            line_pixel_coords = np.column_stack(np.where(binary_mask == 1))[:, ::-1]
-            start_or_end = point_at_start_or_end_assignment(rounded_coords, line_pixel_coords)
-            if temp_image.ndim == 3:
-                start_or_end = np.expand_dims(start_or_end, axis=1)
-            colored_start_or_end = np.where(start_or_end, 0, color)
-            temp_image[line_pixel_coords[:, 1], line_pixel_coords[:, 0]] = colored_start_or_end
-        else:
-            cv2.polylines(temp_image, [rounded_coords.reshape(-1, 1, 2)], False, color, thickness)
+        # Only read and write the pixels of the line, instead of merging a full temporary image
+        ys, xs = self._line_pixel_coords(rounded_coords, image.shape[:2], thickness)
+        current_values = image[ys, xs]
+
+        # Missing channels are zero, like the color scalar in OpenCV
+        color_array = np.zeros(image.shape[2:], dtype=image.dtype)
+        color_array.reshape(-1)[: len(color)] = color[: color_array.size]
+        line_values = np.broadcast_to(color_array, current_values.shape)
 
-        overlap = np.logical_and(temp_image, image).any().item()
-        image = np.where(temp_image == 0, image, temp_image)
+        overlap = np.logical_and(line_values, current_values).any().item()
+        image[ys, xs] = np.where(line_values == 0, current_values, line_values)
 
         return image, overlap
 
@@ -198,11 +552,30 @@ if __name__ == "__main__":
     input_path = Path(args.input)
     output_path = Path(args.output)
 
-    sem_seg = xml_converter.convert(
-        input_path,
-        original_image_shape=None,
-        image_shape=None,
-    )
-
-    # save image
-    save_image_array_to_path(output_path, sem_seg)
+    if input_path.is_dir():
+        # Convert a full dir in a pool, each worker saves its own results
+        xml_paths = sorted(input_path.glob("*.xml"))
+        if not xml_paths:
+            raise FileNotFoundError(f"No xml files found in {input_path}")
+        output_path.mkdir(parents=True, exist_ok=True)
+        output_paths = [output_path.joinpath(xml_path.name).with_suffix(".png") for xml_path in xml_paths]
+
+        workers = args.workers if args.workers is not None else (os.cpu_count() or 1)
+        chunksize = max(1, len(xml_paths) // (4 * workers))
+        converter_bytes = pickle.dumps(xml_converter)
+        with Pool(workers, initializer=_init_convert_worker, initargs=(converter_bytes,)) as pool:
+            for _ in tqdm(
+                pool.imap_unordered(_convert_to_file_worker, zip(xml_paths, output_paths), chunksize=chunksize),
+                total=len(xml_paths),
+                desc="Converting PageXML",
+            ):
+                pass
+    else:
+        sem_seg = xml_converter.convert(
+            input_path,
+            original_image_shape=None,
+            image_shape=None,
+        )
+
+        # save image
+        save_image_array_to_path(output_path, sem_seg)
@@ -26,9 +26,9 @@ class XMLToBinarySeg(_XMLConverter):
         sem_seg = np.zeros((*out_size, 1), np.uint8)
         total_overlap = False
         for baseline_coords in page.iter_baseline_coords():
-            coords = self._scale_coords(baseline_coords, out_size, size)
+            rounded_coords = self._scale_round_coords(baseline_coords, out_size, size)
             sem_seg[..., 0], overlap = self.draw_line(
-                sem_seg[..., 0], coords, baseline_color, thickness=self.xml_regions.line_width
+                sem_seg[..., 0], rounded_coords, baseline_color, thickness=self.xml_regions.line_width
             )
             total_overlap = total_overlap or overlap
 
@@ -48,11 +48,16 @@ class XMLToBinarySeg(_XMLConverter):
         for _ in range(n_classes):
             sem_seg.append(np.zeros((*out_size, 1), np.uint8))
 
-        for element in set(self.xml_regions.region_types.values()):
+        element_classes = []
+        element_coords_list = []
+        for element in self._unique_region_types:
             for element_class, element_coords in page.iter_class_coords(element, self.xml_regions.regions_to_classes):
-                coords = self._scale_coords(element_coords, out_size, size)
-                rounded_coords = np.round(coords).astype(np.int32)
-                cv2.fillPoly(sem_seg[element_class - 1], [rounded_coords], (1,))
+                element_classes.append(element_class)
+                element_coords_list.append(element_coords)
+
+        all_rounded_coords = self._scale_round_coords_batch(element_coords_list, out_size, size)
+        for element_class, rounded_coords in zip(element_classes, all_rounded_coords):
+            cv2.fillPoly(sem_seg[element_class - 1], [rounded_coords], (1,))
 
         sem_seg = np.concatenate(sem_seg, axis=-1)
         if not sem_seg.any():
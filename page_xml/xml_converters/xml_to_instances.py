@@ -1,4 +1,4 @@
-from typing import TypedDict
+from typing import Optional, TypedDict
 
 import cv2
 import numpy as np
@@ -6,7 +6,10 @@ from detectron2 import structures
 from detectron2.config import configurable
 
 from page_xml.page_xml_editor import PageXMLEditor
-from page_xml.xml_converters.xml_converter import _XMLConverter
+from page_xml.xml_converters.xml_converter import _XMLConverter, get_scratch
+
+# Longest allowed miter relative to half the thickness, sharper turns (over 120 degrees) fall back to drawing the line
+_MITER_LIMIT = 2.0
 
 
 class Instance(TypedDict):
@@ -38,13 +41,13 @@ class XMLToInstances(_XMLConverter):
         Create the instance version of the regions
         """
         size = page.get_size()
+        bbox_mode = structures.BoxMode.XYXY_ABS
         instances = []
-        for element in set(self.xml_regions.region_types.values()):
+        for element in self._unique_region_types:
             for element_class, element_coords in page.iter_class_coords(element, self.xml_regions.regions_to_classes):
                 coords = self._scale_coords(element_coords, out_size, size)
                 bbox = self._bounding_box(coords)
-                bbox_mode = structures.BoxMode.XYXY_ABS
-                flattened_coords = coords.flatten().tolist()
+                flattened_coords = coords.ravel().tolist()
                 instance: Instance = {
                     "bbox": bbox,
                     "bbox_mode": bbox_mode,
@@ -64,12 +67,12 @@ class XMLToInstances(_XMLConverter):
         """
         text_line_class = 0
         size = page.get_size()
+        bbox_mode = structures.BoxMode.XYXY_ABS
         instances = []
         for element_coords in page.iter_text_line_coords():
             coords = self._scale_coords(element_coords, out_size, size)
             bbox = self._bounding_box(coords)
-            bbox_mode = structures.BoxMode.XYXY_ABS
-            flattened_coords = coords.flatten().tolist()
+            flattened_coords = coords.ravel().tolist()
             instance: Instance = {
                 "bbox": bbox,
                 "bbox_mode": bbox_mode,
@@ -84,32 +87,84 @@ class XMLToInstances(_XMLConverter):
             self.logger.warning(f"File {page.filepath} does not contains text line instances")
         return instances
 
+    def _thick_line_polygon(self, coords: np.ndarray, out_size: tuple[int, int], thickness: int) -> Optional[np.ndarray]:
+        """
+        Compute the outline of a thick line directly from the coordinates of the line, by offsetting the line along its normals
+
+        Args:
+            coords (np.ndarray): the coordinates of the line
+            out_size (tuple[int, int]): the size of the output image
+            thickness (int): thickness of the line
+
+        Returns:
+            Optional[np.ndarray]: the coordinates of the polygon around the line,
+                None if the line does not have a length or turns too sharply to offset
+        """
+        # Remove consecutive duplicate points, as these do not have a direction
+        keep = np.ones(len(coords), dtype=bool)
+        keep[1:] = np.any(np.diff(coords, axis=0) != 0, axis=1)
+        coords = coords[keep].astype(np.float64)
+        if len(coords) < 2:
+            return None
+
+        half_thickness = thickness / 2
+        directions = np.diff(coords, axis=0)
+        directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+
+        # Without squaring the lines are drawn with round ends, approximate these by extending the ends of the line
+        if not self.square_lines:
+            coords[0] -= directions[0] * half_thickness
+            coords[-1] += directions[-1] * half_thickness
+
+        # The normal at each point is the average of the normals of the segments on either side of it
+        segment_normals = np.column_stack((-directions[:, 1], directions[:, 0]))
+        point_normals = np.empty_like(coords)
+        point_normals[0] = segment_normals[0]
+        point_normals[-1] = segment_normals[-1]
+        point_normals[1:-1] = segment_normals[:-1] + segment_normals[1:]
+        # The summed normal of a point with a turn angle θ has a length of 2 * cos(θ / 2)
+        cos_half_turns = np.linalg.norm(point_normals[1:-1], axis=1, keepdims=True) / 2
+        if np.any(cos_half_turns < 1 / _MITER_LIMIT):
+            return None
+        # Normalize and scale with the miter length 1 / cos(θ / 2), so both offset segments stay half the thickness from the line
+        point_normals[1:-1] /= 2 * cos_half_turns**2
+
+        offsets = point_normals * half_thickness
+        polygon = np.concatenate((coords + offsets, (coords - offsets)[::-1]), axis=0)
+        polygon = np.clip(polygon, 0, np.asarray(out_size[::-1]) - 1)
+        return polygon.astype(np.float32)
+
     def build_baseline(self, page: PageXMLEditor, out_size: tuple[int, int]) -> list[Instance]:
         """
         Create the instance version of the baselines
         """
         baseline_class = 0
         size = page.get_size()
-        mask = np.zeros(out_size, np.uint8)
+        bbox_mode = structures.BoxMode.XYXY_ABS
         instances = []
         for baseline_coords in page.iter_baseline_coords():
             coords = self._scale_coords(baseline_coords, out_size, size)
-            mask.fill(0)
-            # HACK Currently the most simple quickest solution used can probably be optimized
-            mask, _ = self.draw_line(mask, coords, 255, thickness=self.xml_regions.line_width)
-            contours, hierarchy = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-            if len(contours) == 0:
-                raise ValueError(f"{page.filepath} has no contours")
-
-            # Multiple contours should really not happen, but when it does it can still be supported
-            all_coords = []
-            for contour in contours:
-                contour_coords = np.asarray(contour).reshape(-1, 2)
-                all_coords.append(contour_coords)
-            flattened_coords_list = [coords.flatten().tolist() for coords in all_coords]
+            polygon = self._thick_line_polygon(coords, out_size, self.xml_regions.line_width)
+            if polygon is not None:
+                all_coords = [polygon]
+            else:
+                # A line without length (a single dot) or with a sharp turn is drawn, get its outline from the drawn pixels
+                mask = get_scratch("instances_baseline_mask", out_size, np.uint8)
+                rounded_coords = np.rint(coords).astype(np.int32)
+                ys, xs = self._line_pixel_coords(rounded_coords, out_size, self.xml_regions.line_width)
+                mask[ys, xs] = 255
+                contours, hierarchy = cv2.findContours(mask, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+                if len(contours) == 0:
+                    raise ValueError(f"{page.filepath} has no contours")
+
+                # Multiple contours should really not happen, but when it does it can still be supported
+                all_coords = []
+                for contour in contours:
+                    contour_coords = np.asarray(contour).reshape(-1, 2)
+                    all_coords.append(contour_coords)
+            flattened_coords_list = [coords.ravel().tolist() for coords in all_coords]
 
             bbox = self._bounding_box(np.concatenate(all_coords, axis=0))
-            bbox_mode = structures.BoxMode.XYXY_ABS
             instance: Instance = {
                 "bbox": bbox,
                 "bbox_mode": bbox_mode,
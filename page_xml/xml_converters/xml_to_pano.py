@@ -32,18 +32,14 @@ class XMLToPano(_XMLConverter):
     # Taken from https://github.com/cocodataset/panopticapi/blob/master/panopticapi/utils.py
     @staticmethod
     def id2rgb(id_map: int | np.ndarray) -> tuple[int, int, int] | np.ndarray:
+        # Bitwise instead of repeated divmod, this also leaves the input array untouched
         if isinstance(id_map, np.ndarray):
-            rgb_shape = tuple(list(id_map.shape) + [3])
-            rgb_map = np.zeros(rgb_shape, dtype=np.uint8)
-            for i in range(3):
-                rgb_map[..., i] = id_map % 256
-                id_map //= 256
+            rgb_map = np.empty((*id_map.shape, 3), dtype=np.uint8)
+            rgb_map[..., 0] = id_map & 0xFF
+            rgb_map[..., 1] = (id_map >> 8) & 0xFF
+            rgb_map[..., 2] = (id_map >> 16) & 0xFF
             return rgb_map
-        color = []
-        for _ in range(3):
-            color.append(id_map % 256)
-            id_map //= 256
-        return tuple(color)
+        return (id_map & 0xFF, (id_map >> 8) & 0xFF, (id_map >> 16) & 0xFF)
 
     def build_baseline(self, page: PageXMLEditor, out_size: tuple[int, int]) -> tuple[np.ndarray, list[SegmentsInfo]]:
         """
@@ -55,12 +51,12 @@ class XMLToPano(_XMLConverter):
         segments_info = []
         _id = 1
         total_overlap = False
-        for baseline_coords in page.iter_baseline_coords():
-            coords = self._scale_coords(baseline_coords, out_size, size)
-            rgb_color = self.id2rgb(_id)
-            assert isinstance(rgb_color, tuple), "RGB color must be a tuple"
-            assert len(rgb_color) == 3, "RGB color must have 3 values"
-            pano_mask, overlap = self.draw_line(pano_mask, coords, rgb_color, thickness=self.xml_regions.line_width)
+        all_rounded_coords = self._scale_round_coords_batch(list(page.iter_baseline_coords()), out_size, size)
+        for rounded_coords in all_rounded_coords:
+            # Same as id2rgb for a single id, inlined as it is called for every segment
+            rgb_color = (_id & 0xFF, (_id >> 8) & 0xFF, (_id >> 16) & 0xFF)
+            # draw_line merges per channel (a zero channel of the id keeps the value below), so lines are not drawn directly
+            pano_mask, overlap = self.draw_line(pano_mask, rounded_coords, rgb_color, thickness=self.xml_regions.line_width)
             total_overlap = total_overlap or overlap
             segment: SegmentsInfo = {
                 "id": _id,
@@ -84,13 +80,11 @@ class XMLToPano(_XMLConverter):
         pano_mask = np.zeros((*out_size, 3), np.uint8)
         segments_info = []
         _id = 1
-        for element in set(self.xml_regions.region_types.values()):
+        for element in self._unique_region_types:
             for element_class, element_coords in page.iter_class_coords(element, self.xml_regions.regions_to_classes):
-                coords = self._scale_coords(element_coords, out_size, size)
-                rounded_coords = np.round(coords).astype(np.int32)
-                rgb_color = self.id2rgb(_id)
-                assert isinstance(rgb_color, tuple), "RGB color must be a tuple"
-                assert len(rgb_color) == 3, "RGB color must have 3 values"
+                rounded_coords = self._scale_round_coords(element_coords, out_size, size)
+                # Same as id2rgb for a single id, inlined as it is called for every segment
+                rgb_color = (_id & 0xFF, (_id >> 8) & 0xFF, (_id >> 16) & 0xFF)
                 cv2.fillPoly(pano_mask, [rounded_coords], rgb_color)
 
                 segment: SegmentsInfo = {
@@ -115,11 +109,9 @@ class XMLToPano(_XMLConverter):
         segments_info = []
         _id = 1
         for element_coords in page.iter_text_line_coords():
-            coords = self._scale_coords(element_coords, out_size, size)
-            rounded_coords = np.round(coords).astype(np.int32)
-            rgb_color = self.id2rgb(_id)
-            assert isinstance(rgb_color, tuple), "RGB color must be a tuple"
-            assert len(rgb_color) == 3, "RGB color must have 3 values"
+            rounded_coords = self._scale_round_coords(element_coords, out_size, size)
+            # Same as id2rgb for a single id, inlined as it is called for every segment
+            rgb_color = (_id & 0xFF, (_id >> 8) & 0xFF, (_id >> 16) & 0xFF)
             cv2.fillPoly(pano_mask, [rounded_coords], rgb_color)
 
             segment: SegmentsInfo = {
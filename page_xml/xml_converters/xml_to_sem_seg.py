@@ -1,11 +1,18 @@
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from operator import itemgetter
+
 import cv2
 import numpy as np
 from detectron2.config import CfgNode, configurable
 
 from page_xml.page_xml_editor import PageXMLEditor
-from page_xml.xml_converters.xml_converter import _XMLConverter
+from page_xml.xml_converters.xml_converter import _XMLConverter, get_draw_threads
 from utils.vector_utils import point_top_bottom_assignment
 
+# Minimum number of lines each thread should draw, below this the overhead of the threads is larger than the gain
+_MIN_LINES_PER_THREAD = 64
+
 
 class XMLToSemSeg(_XMLConverter):
     """
@@ -18,6 +25,27 @@ class XMLToSemSeg(_XMLConverter):
     def __init__(self, xml_regions, square_lines):
         super().__init__(xml_regions, square_lines)
 
+    def _draw_square_lines(
+        self, all_rounded_coords: list[np.ndarray], out_size: tuple[int, int], color: int
+    ) -> tuple[np.ndarray, bool]:
+        """
+        Draw squared lines of a single color on a new sem_seg
+
+        Args:
+            all_rounded_coords (list[np.ndarray]): the rounded coordinates of the lines
+            out_size (tuple[int, int]): the size of the output image
+            color (int): the color of the lines
+
+        Returns:
+            tuple[np.ndarray, bool]: the sem_seg with the lines and if any of the lines overlap
+        """
+        sem_seg = np.zeros(out_size, np.uint8)
+        total_overlap = False
+        for rounded_coords in all_rounded_coords:
+            sem_seg, overlap = self.draw_line(sem_seg, rounded_coords, color, thickness=self.xml_regions.line_width)
+            total_overlap = total_overlap or overlap
+        return sem_seg, total_overlap
+
     def build_baseline(self, page: PageXMLEditor, out_size: tuple[int, int]) -> np.ndarray:
         """
         Create the sem_seg version of the baselines
@@ -26,10 +54,34 @@ class XMLToSemSeg(_XMLConverter):
         size = page.get_size()
         sem_seg = np.zeros(out_size, np.uint8)
         total_overlap = False
-        for baseline_coords in page.iter_baseline_coords():
-            coords = self._scale_coords(baseline_coords, out_size, size)
-            sem_seg, overlap = self.draw_line(sem_seg, coords, baseline_color, thickness=self.xml_regions.line_width)
-            total_overlap = total_overlap or overlap
+        all_rounded_coords = self._scale_round_coords_batch(list(page.iter_baseline_coords()), out_size, size)
+        if self.square_lines:
+            num_threads = min(get_draw_threads(), len(all_rounded_coords) // _MIN_LINES_PER_THREAD)
+            if num_threads > 1:
+                # All lines have the same color, so pages with many lines can be drawn in separate parts and merged
+                chunk_size = -(-len(all_rounded_coords) // num_threads)
+                chunks = [all_rounded_coords[i : i + chunk_size] for i in range(0, len(all_rounded_coords), chunk_size)]
+                with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                    results = list(executor.map(lambda chunk: self._draw_square_lines(chunk, out_size, baseline_color), chunks))
+                for chunk_sem_seg, _ in results:
+                    np.maximum(sem_seg, chunk_sem_seg, out=sem_seg)
+                # Lines of different parts overlap if the merged sem_seg has fewer pixels than the parts combined
+                total_overlap = any(overlap for _, overlap in results) or np.count_nonzero(sem_seg) < sum(
+                    np.count_nonzero(chunk_sem_seg) for chunk_sem_seg, _ in results
+                )
+            else:
+                sem_seg, total_overlap = self._draw_square_lines(all_rounded_coords, out_size, baseline_color)
+        else:
+            # Without squaring all lines have the same color, so they can be drawn in a single call
+            if all_rounded_coords:
+                cv2.polylines(
+                    sem_seg,
+                    [rounded_coords.reshape(-1, 1, 2) for rounded_coords in all_rounded_coords],
+                    False,
+                    (baseline_color,),
+                    self.xml_regions.line_width,
+                )
+                total_overlap = self._lines_overlap(all_rounded_coords, sem_seg, self.xml_regions.line_width)
 
         if total_overlap:
             self.logger.warning(f"File {page.filepath} contains overlapping baseline sem_seg")
@@ -43,11 +95,17 @@ class XMLToSemSeg(_XMLConverter):
         """
         size = page.get_size()
         sem_seg = np.zeros(out_size, np.uint8)
-        for element in set(self.xml_regions.region_types.values()):
+        element_classes = []
+        element_coords_list = []
+        for element in self._unique_region_types:
             for element_class, element_coords in page.iter_class_coords(element, self.xml_regions.regions_to_classes):
-                coords = self._scale_coords(element_coords, out_size, size)
-                rounded_coords = np.round(coords).astype(np.int32)
-                cv2.fillPoly(sem_seg, [rounded_coords], element_class)
+                element_classes.append(element_class)
+                element_coords_list.append(element_coords)
+
+        # Convert the coordinates of the full page at once, then draw in the original order
+        all_rounded_coords = self._scale_round_coords_batch(element_coords_list, out_size, size)
+        for element_class, rounded_coords in zip(element_classes, all_rounded_coords):
+            cv2.fillPoly(sem_seg, [rounded_coords], element_class)
         if not sem_seg.any():
             self.logger.warning(f"File {page.filepath} does not contains region sem_seg")
         return sem_seg
@@ -59,11 +117,35 @@ class XMLToSemSeg(_XMLConverter):
         size = page.get_size()
         sem_seg = np.zeros(out_size, np.uint8)
         total_overlap = False
-        for element in set(self.xml_regions.region_types.values()):
+        element_classes = []
+        element_coords_list = []
+        for element in self._unique_region_types:
             for element_class, baseline_coords in page.iter_class_baseline_coords(element, self.xml_regions.regions_to_classes):
-                coords = self._scale_coords(baseline_coords, out_size, size)
-                sem_seg, overlap = self.draw_line(sem_seg, coords, element_class, thickness=self.xml_regions.line_width)
+                element_classes.append(element_class)
+                element_coords_list.append(baseline_coords)
+
+        all_rounded_coords = self._scale_round_coords_batch(element_coords_list, out_size, size)
+        if self.square_lines:
+            for element_class, rounded_coords in zip(element_classes, all_rounded_coords):
+                sem_seg, overlap = self.draw_line(sem_seg, rounded_coords, element_class, thickness=self.xml_regions.line_width)
                 total_overlap = total_overlap or overlap
+        else:
+            # Draw each run of lines with the same class in a single call, keeping the original order between classes
+            drawn_rounded_coords = []
+            for element_class, group in groupby(zip(element_classes, all_rounded_coords), key=itemgetter(0)):
+                # Drawing with the background color does not change the sem_seg
+                if element_class == 0:
+                    continue
+                group_rounded_coords = [rounded_coords for _, rounded_coords in group]
+                cv2.polylines(
+                    sem_seg,
+                    [rounded_coords.reshape(-1, 1, 2) for rounded_coords in group_rounded_coords],
+                    False,
+                    (element_class,),
+                    self.xml_regions.line_width,
+                )
+                drawn_rounded_coords.extend(group_rounded_coords)
+            total_overlap = self._lines_overlap(drawn_rounded_coords, sem_seg, self.xml_regions.line_width)
 
         if total_overlap:
             self.logger.warning(f"File {page.filepath} contains overlapping class baseline sem_seg")
@@ -78,9 +160,8 @@ class XMLToSemSeg(_XMLConverter):
         text_line_color = (1,)
         size = page.get_size()
         sem_seg = np.zeros(out_size, np.uint8)
-        for element_coords in page.iter_text_line_coords():
-            coords = self._scale_coords(element_coords, out_size, size)
-            rounded_coords = np.round(coords).astype(np.int32)
+        all_rounded_coords = self._scale_round_coords_batch(list(page.iter_text_line_coords()), out_size, size)
+        for rounded_coords in all_rounded_coords:
             cv2.fillPoly(sem_seg, [rounded_coords], text_line_color)
         if not sem_seg.any():
             self.logger.warning(f"File {page.filepath} does not contains text line sem_seg")
@@ -90,29 +171,19 @@ class XMLToSemSeg(_XMLConverter):
         """
         Create the sem_seg version of the top bottom
         """
-        baseline_color = 1
         top_color = 1
         bottom_color = 2
         size = page.get_size()
         sem_seg = np.zeros(out_size, np.uint8)
-        binary_mask = np.zeros(out_size, dtype=np.uint8)
-        total_overlap = False
         for baseline_coords in page.iter_baseline_coords():
-            coords = self._scale_coords(baseline_coords, out_size, size)
-            binary_mask, overlap = self.draw_line(binary_mask, coords, baseline_color, thickness=self.xml_regions.line_width)
-            total_overlap = total_overlap or overlap
-
-            # Add single line to full sem_seg
-            line_pixel_coords = np.column_stack(np.where(binary_mask == 1))[:, ::-1]
-            rounded_coords = np.round(coords).astype(np.int32)
-            top_bottom = point_top_bottom_assignment(rounded_coords, line_pixel_coords)
-            colored_top_bottom = np.where(top_bottom, top_color, bottom_color)
-            sem_seg[line_pixel_coords[:, 1], line_pixel_coords[:, 0]] = colored_top_bottom
+            rounded_coords = self._scale_round_coords(baseline_coords, out_size, size)
 
-            binary_mask.fill(0)
+            # Add single line to full sem_seg, using the pixels of the line directly instead of drawing and rescanning a mask
+            ys, xs = self._line_pixel_coords(rounded_coords, out_size, self.xml_regions.line_width)
+            top_bottom = point_top_bottom_assignment(rounded_coords, xs, ys)
+            colored_top_bottom = np.where(top_bottom, np.uint8(top_color), np.uint8(bottom_color))
+            sem_seg[ys, xs] = colored_top_bottom
 
-        if total_overlap:
-            self.logger.warning(f"File {page.filepath} contains overlapping top bottom sem_seg")
         if not sem_seg.any():
             self.logger.warning(f"File {page.filepath} does not contains top bottom sem_seg")
         return sem_seg
@@ -124,10 +195,10 @@ class XMLToSemSeg(_XMLConverter):
         start_color = (1,)
         size = page.get_size()
         sem_seg = np.zeros(out_size, np.uint8)
-        for baseline_coords in page.iter_baseline_coords():
-            coords = self._scale_coords(baseline_coords, out_size, size)[0]
-            rounded_coords = np.round(coords).astype(np.int32)
-            cv2.circle(sem_seg, rounded_coords, self.xml_regions.line_width, start_color, -1)
+        # Only the start points are needed, so only these are scaled
+        starts, _ = self._scale_round_endpoints(list(page.iter_baseline_coords()), out_size, size)
+        for coords_start in starts:
+            cv2.circle(sem_seg, coords_start, self.xml_regions.line_width, start_color, -1)
         if not sem_seg.any():
             self.logger.warning(f"File {page.filepath} does not contains start sem_seg")
         return sem_seg
@@ -139,10 +210,10 @@ class XMLToSemSeg(_XMLConverter):
         end_color = (1,)
         size = page.get_size()
         sem_seg = np.zeros(out_size, np.uint8)
-        for baseline_coords in page.iter_baseline_coords():
-            coords = self._scale_coords(baseline_coords, out_size, size)[-1]
-            rounded_coords = np.round(coords).astype(np.int32)
-            cv2.circle(sem_seg, rounded_coords, self.xml_regions.line_width, end_color, -1)
+        # Only the end points are needed, so only these are scaled
+        _, ends = self._scale_round_endpoints(list(page.iter_baseline_coords()), out_size, size)
+        for coords_end in ends:
+            cv2.circle(sem_seg, coords_end, self.xml_regions.line_width, end_color, -1)
         if not sem_seg.any():
             self.logger.warning(f"File {page.filepath} does not contains end sem_seg")
         return sem_seg
@@ -154,12 +225,10 @@ class XMLToSemSeg(_XMLConverter):
         separator_color = (1,)
         size = page.get_size()
         sem_seg = np.zeros(out_size, np.uint8)
-        for baseline_coords in page.iter_baseline_coords():
-            coords = self._scale_coords(baseline_coords, out_size, size)
-            rounded_coords = np.round(coords).astype(np.int32)
-            coords_start = rounded_coords[0]
+        # All separators have the same color, so the drawing order does not matter and only the endpoints are scaled
+        starts, ends = self._scale_round_endpoints(list(page.iter_baseline_coords()), out_size, size)
+        for coords_start, coords_end in zip(starts, ends):
             cv2.circle(sem_seg, coords_start, self.xml_regions.line_width, separator_color, -1)
-            coords_end = rounded_coords[-1]
             cv2.circle(sem_seg, coords_end, self.xml_regions.line_width, separator_color, -1)
         if not sem_seg.any():
             self.logger.warning(f"File {page.filepath} does not contains separator sem_seg")
@@ -175,9 +244,9 @@ class XMLToSemSeg(_XMLConverter):
         size = page.get_size()
         sem_seg = np.zeros(out_size, np.uint8)
         total_overlap = False
-        for baseline_coords in page.iter_baseline_coords():
-            coords = self._scale_coords(baseline_coords, out_size, size)
-            rounded_coords = np.round(coords).astype(np.int32)
+        # The lines and separators are drawn interleaved, as later lines can be drawn over earlier separators
+        all_rounded_coords = self._scale_round_coords_batch(list(page.iter_baseline_coords()), out_size, size)
+        for rounded_coords in all_rounded_coords:
             sem_seg, overlap = self.draw_line(sem_seg, rounded_coords, baseline_color, thickness=self.xml_regions.line_width)
             total_overlap = total_overlap or overlap
 
@@ -47,7 +47,7 @@ class XMLToYOLOSegmentation(_XMLConverter):
         out_size = (1, 1)
         size = page.get_size()
         annotations = []
-        for element in set(self.xml_regions.region_types.values()):
+        for element in self._unique_region_types:
             for element_class, element_coords in page.iter_class_coords(element, self.xml_regions.regions_to_classes):
                 coords = self._normalize_coords(element_coords, size)
                 coords = coords.flatten().tolist()
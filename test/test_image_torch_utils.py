@@ -0,0 +1,73 @@
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+sys.path.append(str(Path(__file__).resolve().parent.joinpath("..")))
+from utils.image_utils import load_image_array_from_path
+
+_TORCH_IMPORTED = True
+try:
+    from utils.image_torch_utils import load_image_array_via_torchvision
+except ImportError:
+    # torch and torchvision are only needed for these tests, skip them when they are not installed
+    _TORCH_IMPORTED = False
+
+
+@unittest.skipUnless(_TORCH_IMPORTED, "torch is not installed")
+class TestLoadImageArrayViaTorchvision(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory("_laypa_test")
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def save_image(self, name: str, orientation: int = 1) -> Path:
+        y, x = np.mgrid[0:30, 0:40]
+        image = Image.fromarray(np.stack((x * 6, y * 8, 255 - x * 6), axis=-1).astype(np.uint8))
+        exif = Image.Exif()
+        exif[0x0112] = orientation
+        image_path = Path(self.tmp_dir.name).joinpath(name)
+        image.save(image_path, dpi=(300, 300), exif=exif)
+        return image_path
+
+    def assert_same_as_pil(self, image_path: Path, mode: str, ignore_exif: bool, max_difference: int = 0):
+        data = load_image_array_via_torchvision(image_path, mode=mode, ignore_exif=ignore_exif)
+        expected = load_image_array_from_path(image_path, mode=mode, ignore_exif=ignore_exif)
+
+        self.assertIsNotNone(data, "Image was not loaded with torchvision")
+        self.assertIsNotNone(expected, "Image was not loaded with PIL")
+        assert data is not None and expected is not None
+        self.assertEqual(expected["image"].dtype, data["image"].dtype)
+        self.assertEqual(expected["image"].shape, data["image"].shape)
+        self.assertTrue(data["image"].flags.c_contiguous, "Image is not contiguous")
+        self.assertEqual(expected["dpi"], data["dpi"])
+        self.assertLessEqual(np.abs(data["image"].astype(np.int16) - expected["image"]).max(), max_difference)
+
+    def test_jpeg(self):
+        image_path = self.save_image("image.jpg")
+        for ignore_exif in [False, True]:
+            self.assert_same_as_pil(image_path, "color", ignore_exif)
+            self.assert_same_as_pil(image_path, "grayscale", ignore_exif)
+
+    def test_jpeg_exif_orientation(self):
+        image_path = self.save_image("rotated.jpg", orientation=6)
+        for ignore_exif in [False, True]:
+            self.assert_same_as_pil(image_path, "color", ignore_exif)
+            self.assert_same_as_pil(image_path, "grayscale", ignore_exif)
+
+        rotated = load_image_array_via_torchvision(image_path, mode="color")
+        assert rotated is not None
+        self.assertEqual((40, 30, 3), rotated["image"].shape)
+
+    def test_png(self):
+        image_path = self.save_image("image.png")
+        for ignore_exif in [False, True]:
+            self.assert_same_as_pil(image_path, "color", ignore_exif)
+            # torchvision rounds the conversion from RGB to grayscale differently than PIL
+            self.assert_same_as_pil(image_path, "grayscale", ignore_exif, max_difference=1)
+
+
+if __name__ == "__main__":
+    unittest.main()
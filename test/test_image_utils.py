@@ -0,0 +1,303 @@
+import struct
+import sys
+import tempfile
+import unittest
+import zlib
+from pathlib import Path
+from unittest import mock
+
+import numpy as np
+from PIL import Image
+
+sys.path.append(str(Path(__file__).resolve().parent.joinpath("..")))
+from utils import image_utils
+from utils.image_utils import (
+    _dpi_to_int,
+    load_image_array_from_path,
+    load_image_array_resized,
+    read_image_dpi,
+    read_image_header,
+    set_grayscale_from_rgb,
+)
+
+
+class TestLoadImageArray(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory("_laypa_test")
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def save_cmyk_jpeg(self) -> Path:
+        rng = np.random.default_rng(0)
+        image = Image.fromarray(rng.integers(0, 256, (32, 48, 4), dtype=np.uint8), mode="CMYK")
+        image_path = Path(self.tmp_dir.name).joinpath("cmyk.jpg")
+        image.save(image_path, dpi=(300, 300))
+        return image_path
+
+    def test_cmyk_jpeg(self):
+        image_path = self.save_cmyk_jpeg()
+
+        data = load_image_array_from_path(image_path)
+
+        self.assertIsNotNone(data, "CMYK JPEG was not loaded")
+        assert data is not None
+        with Image.open(image_path) as image:
+            expected = np.asarray(image.convert("RGB"))
+        np.testing.assert_array_equal(data["image"], expected)
+        self.assertEqual(300, data["dpi"])
+
+    def test_cmyk_jpeg_turbojpeg_fails(self):
+        image_path = self.save_cmyk_jpeg()
+        # libjpeg-turbo cannot convert CMYK to RGB, the loader should fall back to PIL instead of skipping the image
+        decoder = mock.Mock()
+        decoder.decode.side_effect = OSError("Unsupported color conversion request")
+        with (
+            mock.patch.object(image_utils, "_get_turbojpeg", return_value=decoder),
+            mock.patch.dict(image_utils._TURBOJPEG_PIXEL_FORMATS, {("color", "RGB"): 0}),
+        ):
+            data = load_image_array_from_path(image_path)
+
+        decoder.decode.assert_called_once()
+        self.assertIsNotNone(data, "CMYK JPEG was skipped after libjpeg-turbo failed")
+        assert data is not None
+        with Image.open(image_path) as image:
+            expected = np.asarray(image.convert("RGB"))
+        np.testing.assert_array_equal(data["image"], expected)
+
+    def save_color_jpeg(self) -> Path:
+        # Smooth colors like a scan, sharp color edges differ more after chroma subsampling
+        y, x = np.mgrid[0:32, 0:48]
+        image = Image.fromarray(np.stack((x * 5, y * 7, 255 - x * 3), axis=-1).astype(np.uint8))
+        image_path = Path(self.tmp_dir.name).joinpath("color.jpg")
+        image.save(image_path)
+        return image_path
+
+    def test_grayscale_jpeg(self):
+        image_path = self.save_color_jpeg()
+
+        data = load_image_array_from_path(image_path, mode="grayscale")
+
+        self.assertIsNotNone(data, "Grayscale JPEG was not loaded")
+        assert data is not None
+        with Image.open(image_path) as image:
+            expected = np.asarray(image.convert("RGB").convert("L"))
+        self.assertEqual(expected.shape, data["image"].shape)
+        # The luminance plane is decoded directly, which differs slightly from converting the decoded RGB image
+        self.assertLessEqual(np.abs(data["image"].astype(np.int16) - expected).max(), 2)
+
+    def test_grayscale_jpeg_from_rgb(self):
+        image_path = self.save_color_jpeg()
+        set_grayscale_from_rgb(True)
+        self.addCleanup(set_grayscale_from_rgb, False)
+
+        data = load_image_array_from_path(image_path, mode="grayscale")
+
+        self.assertIsNotNone(data, "Grayscale JPEG was not loaded")
+        assert data is not None
+        with Image.open(image_path) as image:
+            expected = np.asarray(image.convert("RGB").convert("L"))
+        np.testing.assert_array_equal(data["image"], expected)
+
+
+@unittest.skipUnless(image_utils._PYVIPS_IMPORTED, "pyvips is not installed")
+class TestLoadImageArrayResizedPyvips(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory("_laypa_test")
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def save_image(self, name: str, orientation: int = 1) -> Path:
+        y, x = np.mgrid[0:300, 0:400]
+        image = Image.fromarray(np.stack((x * 255 // 400, y * 255 // 300, 255 - x * 255 // 400), axis=-1).astype(np.uint8))
+        exif = Image.Exif()
+        exif[0x0112] = orientation
+        image_path = Path(self.tmp_dir.name).joinpath(name)
+        image.save(image_path, dpi=(300, 300), exif=exif)
+        return image_path
+
+    def assert_same_as_fallback(self, image_path: Path, mode: str, ignore_exif: bool = False):
+        data = load_image_array_resized(image_path, 100, mode=mode, ignore_exif=ignore_exif)
+        with mock.patch.object(image_utils, "_PYVIPS_IMPORTED", False):
+            expected = load_image_array_resized(image_path, 100, mode=mode, ignore_exif=ignore_exif)
+
+        self.assertIsNotNone(data, "Image was not loaded with pyvips")
+        self.assertIsNotNone(expected, "Image was not loaded without pyvips")
+        assert data is not None and expected is not None
+        self.assertEqual(np.uint8, data["image"].dtype)
+        self.assertEqual(expected["image"].shape, data["image"].shape)
+        self.assertEqual(expected["dpi"], data["dpi"])
+        # Both backends resample differently, the values should still be close
+        self.assertLess(np.abs(data["image"].astype(np.int16) - expected["image"]).mean(), 4)
+
+    def test_jpeg(self):
+        image_path = self.save_image("image.jpg")
+        self.assert_same_as_fallback(image_path, "color")
+        self.assert_same_as_fallback(image_path, "grayscale")
+
+    def test_png(self):
+        image_path = self.save_image("image.png")
+        self.assert_same_as_fallback(image_path, "color")
+        self.assert_same_as_fallback(image_path, "grayscale")
+
+    def test_shape_and_dpi(self):
+        image_path = self.save_image("image.jpg")
+
+        color = load_image_array_resized(image_path, 100, mode="color")
+        grayscale = load_image_array_resized(image_path, 100, mode="grayscale")
+
+        assert color is not None and grayscale is not None
+        self.assertEqual((75, 100, 3), color["image"].shape)
+        self.assertEqual((75, 100), grayscale["image"].shape)
+        self.assertEqual(75, color["dpi"])
+
+    def test_exif_orientation(self):
+        image_path = self.save_image("rotated.jpg", orientation=6)
+
+        rotated = load_image_array_resized(image_path, 100, mode="color")
+        not_rotated = load_image_array_resized(image_path, 100, mode="color", ignore_exif=True)
+
+        assert rotated is not None and not_rotated is not None
+        self.assertEqual((100, 75, 3), rotated["image"].shape)
+        self.assertEqual((75, 100, 3), not_rotated["image"].shape)
+        self.assertEqual(75, rotated["dpi"])
+        self.assert_same_as_fallback(image_path, "color")
+        self.assert_same_as_fallback(image_path, "color", ignore_exif=True)
+
+
+class TestReadImageHeader(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory("_laypa_test")
+        self.addCleanup(self.tmp_dir.cleanup)
+
+    def save_image(self, name: str, **kwargs) -> Path:
+        y, x = np.mgrid[0:30, 0:40]
+        image = Image.fromarray(np.stack((x * 6, y * 8, 255 - x * 6), axis=-1).astype(np.uint8))
+        image_path = Path(self.tmp_dir.name).joinpath(name)
+        image.save(image_path, **kwargs)
+        return image_path
+
+    def save_jfif_jpeg(self, name: str, unit: int, density: int) -> Path:
+        image_path = self.save_image(name, dpi=(300, 300))
+        image_bytes = bytearray(image_path.read_bytes())
+        jfif_start = image_bytes.index(b"JFIF\x00")
+        image_bytes[jfif_start + 7] = unit
+        image_bytes[jfif_start + 8 : jfif_start + 12] = struct.pack(">HH", density, density)
+        image_path.write_bytes(image_bytes)
+        return image_path
+
+    def save_exif_only_jpeg(self, name: str, exif: Image.Exif) -> Path:
+        image_path = self.save_image(name, exif=exif)
+        image_bytes = image_path.read_bytes()
+        # Remove the JFIF segment, so the resolution can only come from the EXIF data
+        if image_bytes[2:4] == b"\xff\xe0":
+            app0_length = struct.unpack(">H", image_bytes[4:6])[0]
+            image_bytes = image_bytes[:2] + image_bytes[4 + app0_length :]
+        self.assertNotIn(b"JFIF\x00", image_bytes)
+        image_path.write_bytes(image_bytes)
+        return image_path
+
+    def assert_header_matches_pil(self, image_path: Path):
+        try:
+            with Image.open(image_path) as image:
+                expected = ((image.height, image.width), _dpi_to_int(image.info.get("dpi")))
+        except OSError:
+            with self.assertRaises(ValueError, msg=f"Invalid image {image_path.name} was read"):
+                read_image_header(image_path)
+            return
+        self.assertEqual(expected, read_image_header(image_path), f"Header of {image_path.name} does not match PIL")
+        self.assertEqual(expected[1], read_image_dpi(image_path), f"DPI of {image_path.name} does not match PIL")
+
+    def test_png(self):
+        self.assert_header_matches_pil(self.save_image("phys.png", dpi=(300, 300)))
+        self.assert_header_matches_pil(self.save_image("phys_rounded.png", dpi=(72, 72)))
+        self.assert_header_matches_pil(self.save_image("no_phys.png"))
+
+    def test_png_phys_without_unit(self):
+        image_path = self.save_image("phys_unit_0.png", dpi=(300, 300))
+        image_bytes = bytearray(image_path.read_bytes())
+        # The unit is the last byte of the pHYs data, followed by the CRC of the type and data
+        phys_start = image_bytes.index(b"pHYs") + 4
+        image_bytes[phys_start + 8] = 0
+        image_bytes[phys_start + 9 : phys_start + 13] = struct.pack(
+            ">I", zlib.crc32(image_bytes[phys_start - 4 : phys_start + 9])
+        )
+        image_path.write_bytes(image_bytes)
+        self.assert_header_matches_pil(image_path)
+
+    def test_jpeg_jfif_units(self):
+        for unit, density in [(0, 1), (0, 300), (1, 300), (1, 72), (2, 118), (2, 120)]:
+            self.assert_header_matches_pil(self.save_jfif_jpeg(f"jfif_{unit}_{density}.jpg", unit, density))
+
+    def test_jpeg_without_dpi(self):
+        self.assert_header_matches_pil(self.save_image("no_dpi.jpg"))
+
+    def test_jpeg_exif_resolution(self):
+        for resolution_unit, resolution in [(2, 300), (2, 150.4), (3, 118)]:
+            exif = Image.Exif()
+            exif[0x0128] = resolution_unit
+            exif[0x011A] = resolution
+            exif[0x011B] = resolution
+            image_path = self.save_exif_only_jpeg(f"exif_{resolution_unit}_{resolution}.jpg", exif)
+            self.assert_header_matches_pil(image_path)
+
+    def test_jpeg_exif_without_resolution(self):
+        exif = Image.Exif()
+        exif[0x0112] = 1
+        image_path = self.save_exif_only_jpeg("exif_no_resolution.jpg", exif)
+        # PIL defaults to 72 DPI for EXIF data without a resolution
+        self.assertEqual(72, read_image_header(image_path)[1])
+        self.assert_header_matches_pil(image_path)
+
+    def test_jpeg_jfif_and_exif(self):
+        exif = Image.Exif()
+        exif[0x0128] = 2
+        exif[0x011A] = 150
+        exif[0x011B] = 150
+        self.assert_header_matches_pil(self.save_image("jfif_exif.jpg", dpi=(300, 300), exif=exif))
+
+    def test_truncated_jpeg(self):
+        exif = Image.Exif()
+        exif[0x0128] = 2
+        exif[0x011A] = 150
+        exif[0x011B] = 150
+        image_path = self.save_image("full.jpg", dpi=(300, 300), exif=exif)
+        image_bytes = image_path.read_bytes()
+        sof_start = image_bytes.index(b"\xff\xc0")
+        cuts = [
+            3,  # In the first marker
+            image_bytes.index(b"JFIF") + 6,  # In the JFIF segment
+            image_bytes.index(b"Exif") + 20,  # In the EXIF segment
+            sof_start + 2,  # In the length of the SOF segment
+            sof_start + 6,  # In the size in the SOF segment
+            image_bytes.index(b"\xff\xda") + 20,  # In the image data
+        ]
+        for cut in cuts:
+            truncated_path = Path(self.tmp_dir.name).joinpath(f"truncated_{cut}.jpg")
+            truncated_path.write_bytes(image_bytes[:cut])
+            self.assert_header_matches_pil(truncated_path)
+
+    def test_truncated_png(self):
+        image_path = self.save_image("full.png", dpi=(300, 300))
+        image_bytes = image_path.read_bytes()
+        cuts = [
+            4,  # In the signature
+            image_bytes.index(b"IHDR") + 6,  # In IHDR
+            image_bytes.index(b"pHYs") + 4,  # Directly after the type of the pHYs chunk
+            image_bytes.index(b"pHYs") + 8,  # In the pHYs data
+            image_bytes.index(b"IDAT") + 10,  # In the image data
+        ]
+        for cut in cuts:
+            truncated_path = Path(self.tmp_dir.name).joinpath(f"truncated_{cut}.png")
+            truncated_path.write_bytes(image_bytes[:cut])
+            self.assert_header_matches_pil(truncated_path)
+
+    def test_png_truncated_in_phys(self):
+        image_path = Path(self.tmp_dir.name).joinpath("truncated.png")
+        Image.new("RGB", (40, 30)).save(image_path, dpi=(300, 300))
+        image_bytes = image_path.read_bytes()
+        image_path.write_bytes(image_bytes[: image_bytes.index(b"pHYs") + 4])
+
+        with self.assertRaises(ValueError):
+            read_image_header(image_path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,17 +1,99 @@
 import logging
 import sys
+import warnings
 from io import BytesIO
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Sequence
 
 import imagesize
+import numpy as np
 import torch
 import torchvision
 from PIL import Image
 
-sys.path.append(str(Path(__file__).resolve().parent.joinpath("..")))
+# Only needed when running this file directly, as a module of the utils package the repo root is already importable
+if not __package__:
+    sys.path.append(str(Path(__file__).resolve().parent.joinpath("..")))
+from utils.image_utils import read_image_dpi
 from utils.logging_utils import get_logger_name
 
+logger = logging.getLogger(get_logger_name())
+
+
+_JPEG_SIGNATURE = b"\xff\xd8\xff"
+
+
+def _decode_image_tensor(data: torch.Tensor, mode: str, device: torch.device | str) -> torch.Tensor:
+    """
+    Decode an encoded image, JPEGs are decoded on the GPU directly (nvJPEG) when the device is a CUDA device
+
+    Args:
+        data (torch.Tensor): 1D uint8 tensor with the encoded image
+        mode (str): color mode, either "color" or "grayscale"
+        device (torch.device | str): the device to load the image tensor to
+
+    Returns:
+        torch.Tensor: the decoded image on the device
+    """
+    device = torch.device(device)
+    torchvision_mode = torchvision.io.ImageReadMode.RGB if mode == "color" else torchvision.io.ImageReadMode.GRAY
+    if device.type == "cuda" and bytes(data[:3].tolist()) == _JPEG_SIGNATURE:
+        # Only the compressed bytes are copied to the GPU, instead of the decoded image
+        return torchvision.io.decode_jpeg(data, mode=torchvision_mode, device=device)  # type: ignore
+    image = torchvision.io.decode_image(data, torchvision_mode)
+    return image.to(device)
+
+
+def _read_image_tensor_dpi(image_path: Path | str) -> Optional[int]:
+    """
+    Read the dpi of an image from its header
+
+    Args:
+        image_path (Path | str): path to an image on current filesystem
+
+    Raises:
+        ValueError: the dpi is invalid or not square
+
+    Returns:
+        Optional[int]: the dpi, None if the image has no dpi
+    """
+    dpi = imagesize.getDPI(image_path)
+    if len(dpi) != 2:
+        raise ValueError(f"Invalid DPI: {dpi}")
+    if dpi[0] != dpi[1]:
+        raise ValueError(f"Non-square DPI: {dpi}")
+    if dpi == (-1, -1):
+        return None
+    return dpi[0]
+
+
+def _load_image_tensor_from_data(
+    data: torch.Tensor,
+    image_path: Path | str,
+    mode: str,
+    device: torch.device | str,
+) -> Optional[dict]:
+    """
+    Decode the already read bytes of an image, return None if loading failed due to corruption
+
+    Args:
+        data (torch.Tensor): 1D uint8 tensor with the encoded image
+        image_path (Path | str): path the bytes were read from, for the dpi and logging
+        mode (str): color mode, either "color" or "grayscale"
+        device (torch.device | str): the device to load the image tensor to
+
+    Returns:
+        Optional[dict]: the loaded image and its dpi or None
+    """
+    try:
+        image = _decode_image_tensor(data, mode, device)
+        dpi = _read_image_tensor_dpi(image_path)
+    except (OSError, RuntimeError, ValueError):
+        # nvJPEG raises a RuntimeError for a corrupt JPEG
+        logger.warning(f"Cannot load image: {image_path} skipping for now")
+        return None
+    return {"image": image, "dpi": dpi}
+
 
 def load_image_tensor_from_path_gpu_decode(
     path: str | Path,
@@ -61,7 +143,6 @@ def load_image_tensor_from_path_gpu_decode(
 
         return {"image": image, "dpi": dpi}
     except OSError:
-        logger = logging.getLogger(get_logger_name())
         logger.warning(f"Cannot load image: {path} skipping for now")
         return None
 
@@ -69,6 +150,7 @@ def load_image_tensor_from_path_gpu_decode(
 def load_image_tensor_from_path(
     image_path: Path | str,
     mode: str = "color",
+    device: torch.device | str = "cpu",
 ) -> Optional[dict]:
     """
     Load image from a given path, return None if loading failed due to corruption
@@ -76,6 +158,7 @@ def load_image_tensor_from_path(
     Args:
         image_path (Path | str): path to an image on current filesystem
         mode (str): color mode, either "color" or "grayscale"
+        device (torch.device | str, optional): the device to load the image tensor to, JPEGs are decoded on a CUDA device directly. Defaults to "cpu".
 
     Returns:
         Optional[np.ndarray]: the loaded image or None
@@ -83,29 +166,18 @@ def load_image_tensor_from_path(
     assert mode in ["color", "grayscale"], f'Mode "{mode}" not supported'
 
     try:
-        image = torchvision.io.read_image(
-            str(image_path), torchvision.io.ImageReadMode.RGB if mode == "color" else torchvision.io.ImageReadMode.GRAY
-        )
-
-        dpi = imagesize.getDPI(image_path)
-        assert len(dpi) == 2, f"Invalid DPI: {dpi}"
-        assert dpi[0] == dpi[1], f"Non-square DPI: {dpi}"
-        if dpi == (-1, -1):
-            dpi = None
-        else:
-            dpi = dpi[0]
-
-        return {"image": image, "dpi": dpi}
-    except OSError:
-        logger = logging.getLogger(get_logger_name())
+        data = torchvision.io.read_file(str(image_path))
+    except (OSError, RuntimeError):
         logger.warning(f"Cannot load image: {image_path} skipping for now")
         return None
+    return _load_image_tensor_from_data(data, image_path, mode, device)
 
 
 def load_image_tensor_from_bytes(
     image_bytes: bytes,
     image_path: Optional[Path] = None,
     mode: str = "color",
+    device: torch.device | str = "cpu",
 ) -> Optional[dict]:
     """
     Load image based on given bytes, return None if loading failed due to corruption
@@ -114,6 +186,7 @@ def load_image_tensor_from_bytes(
         image_bytes (bytes): transfer bytes of data that represent an image
         image_path (Optional[Path], optional): image_path for logging. Defaults to None.
         mode (str, optional): color mode, either "color" or "grayscale". Defaults to "color"
+        device (torch.device | str, optional): the device to load the image tensor to, JPEGs are decoded on a CUDA device directly. Defaults to "cpu".
 
     Returns:
         Optional[np.ndarray]: the loaded image or None
@@ -121,10 +194,11 @@ def load_image_tensor_from_bytes(
     assert mode in ["color", "grayscale"], f'Mode "{mode}" not supported'
 
     try:
-        tensor = torch.frombuffer(bytearray(image_bytes), dtype=torch.uint8)
-        image = torchvision.io.decode_image(
-            tensor, torchvision.io.ImageReadMode.RGB if mode == "color" else torchvision.io.ImageReadMode.GRAY
-        )
+        # Decoding only reads the buffer, so share the memory of the bytes instead of copying them to a writable bytearray
+        with warnings.catch_warnings():
+            warnings.filterwarnings("ignore", message="The given buffer is not writable")
+            tensor = torch.frombuffer(image_bytes, dtype=torch.uint8)
+        image = _decode_image_tensor(tensor, mode, device)
         image_dpi = Image.open(BytesIO(image_bytes))
         dpi = image_dpi.info.get("dpi")
         if dpi is not None:
@@ -134,11 +208,111 @@ def load_image_tensor_from_bytes(
         return {"image": image, "dpi": dpi}
     except OSError:
         image_path_info = image_path if image_path is not None else "Filename not given"
-        logger = logging.getLogger(get_logger_name())
         logger.warning(f"Cannot load image: {image_path_info}. skipping for now")
         return None
 
 
+def load_image_array_via_torchvision(
+    image_path: Path | str,
+    mode: str = "color",
+    ignore_exif: bool = False,
+) -> Optional[dict]:
+    """
+    Load image from a given path as a numpy array, decoding with torchvision instead of PIL
+
+    torchvision releases the GIL for the whole read and decode, so this scales with the number of threads when used in a ThreadPoolExecutor
+
+    Args:
+        image_path (Path | str): path to an image on current filesystem
+        mode (str, optional): color mode, either "color" or "grayscale". Defaults to "color".
+        ignore_exif (bool, optional): Ignore exif orientation. Defaults to False.
+
+    Returns:
+        Optional[dict]: the loaded image (HxWxC for color, HxW for grayscale, like load_image_array_from_path) and dpi, or None.
+            The pixels are the same as those of load_image_array_from_path, except for grayscale images of non-JPEG color images,
+            where torchvision rounds the conversion from RGB differently than PIL (at most 1 level)
+    """
+    assert mode in ["color", "grayscale"], f'Mode "{mode}" not supported'
+
+    try:
+        torchvision_mode = torchvision.io.ImageReadMode.RGB if mode == "color" else torchvision.io.ImageReadMode.GRAY
+        image = torchvision.io.decode_image(
+            torchvision.io.read_file(str(image_path)), torchvision_mode, apply_exif_orientation=not ignore_exif
+        )
+        if mode == "color":
+            # CHW to HWC, the only copy after decoding
+            image_array = np.ascontiguousarray(image.permute(1, 2, 0).numpy())
+        else:
+            # The single channel is already laid out as HxW, only an EXIF rotation (a transposed view) still needs a copy
+            image_array = np.ascontiguousarray(image[0].numpy())
+        dpi = read_image_dpi(image_path)
+        return {"image": image_array, "dpi": dpi}
+    except (OSError, RuntimeError):
+        logger.warning(f"Cannot load image: {image_path} skipping for now")
+        return None
+
+
+def load_image_tensor_batch(
+    image_paths: Sequence[Path | str],
+    mode: str = "color",
+    device: torch.device | str = "cpu",
+) -> list[Optional[dict]]:
+    """
+    Load multiple images at once, on a CUDA device all JPEGs are decoded in a single batched nvJPEG call
+
+    Args:
+        image_paths (Sequence[Path | str]): paths to images on current filesystem
+        mode (str, optional): color mode, either "color" or "grayscale". Defaults to "color".
+        device (torch.device | str, optional): the device to load the image tensors to. Defaults to "cpu".
+
+    Returns:
+        list[Optional[dict]]: the loaded images and their dpi, None for images that could not be loaded
+    """
+    assert mode in ["color", "grayscale"], f'Mode "{mode}" not supported'
+    device = torch.device(device)
+
+    if device.type != "cuda":
+        return [load_image_tensor_from_path(image_path, mode=mode, device=device) for image_path in image_paths]
+
+    results: list[Optional[dict]] = [None] * len(image_paths)
+    # Every file is read once, the bytes are reused when an image has to be decoded on its own
+    all_data: dict[int, torch.Tensor] = {}
+    jpeg_indices = []
+    for i, image_path in enumerate(image_paths):
+        try:
+            data = torchvision.io.read_file(str(image_path))
+        except (OSError, RuntimeError):
+            logger.warning(f"Cannot load image: {image_path} skipping for now")
+            continue
+        all_data[i] = data
+        if bytes(data[:3].tolist()) == _JPEG_SIGNATURE:
+            jpeg_indices.append(i)
+
+    if jpeg_indices:
+        torchvision_mode = torchvision.io.ImageReadMode.RGB if mode == "color" else torchvision.io.ImageReadMode.GRAY
+        try:
+            images = torchvision.io.decode_jpeg(
+                [all_data[i] for i in jpeg_indices], mode=torchvision_mode, device=device  # type: ignore
+            )
+        except RuntimeError:
+            # A single corrupt image fails the whole batch, these are decoded one by one below
+            images = []
+        for i, image in zip(jpeg_indices, images):
+            del all_data[i]
+            try:
+                dpi = _read_image_tensor_dpi(image_paths[i])
+            except (OSError, ValueError):
+                # An invalid dpi only fails this image, not the whole batch
+                logger.warning(f"Cannot load image: {image_paths[i]} skipping for now")
+                continue
+            results[i] = {"image": image, "dpi": dpi}
+
+    for i, data in all_data.items():
+        results[i] = _load_image_tensor_from_data(data, image_paths[i], mode, device)
+
+    return results
+
+
 if __name__ == "__main__":
     image = load_image_tensor_from_path_gpu_decode(
         Path("~/Documents/datasets/mini-republic/train/NL-HaNA_1.01.02_62_0109.jpg").expanduser(),
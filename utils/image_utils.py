@@ -1,19 +1,78 @@
 import logging
+import mmap
+import struct
 import sys
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from io import BytesIO
 from pathlib import Path
-from typing import Optional
+from typing import BinaryIO, Callable, Iterable, Iterator, Optional, Sequence
 
-# import cv2
+import cv2
 import numpy as np
-from PIL import Image, ImageOps
+from PIL import Image
 
-sys.path.append(str(Path(__file__).resolve().parent.joinpath("..")))
+# Only needed when running this file directly, as a module of the utils package the repo root is already importable
+if not __package__:
+    sys.path.append(str(Path(__file__).resolve().parent.joinpath("..")))
 from utils.logging_utils import get_logger_name
 
+logger = logging.getLogger(get_logger_name())
+
+_TURBOJPEG_IMPORTED = True
+try:
+    import turbojpeg
+except ImportError:
+    # PyTurboJPEG is an optional dependency, it only speeds up decoding JPEG images
+    _TURBOJPEG_IMPORTED = False
+
+_PYVIPS_IMPORTED = True
+try:
+    import pyvips
+except (ImportError, OSError):
+    # pyvips is an optional dependency, it lowers the memory used when loading very large images at a reduced size
+    # The python package raises an OSError when libvips itself cannot be found
+    _PYVIPS_IMPORTED = False
+
+# PIL mode to decode to for each color mode, also the supported color modes
+_PIL_MODES = {"color": "RGB", "grayscale": "L", "ycbcr": "YCbCr"}
+# libjpeg-turbo output for each color mode and image format, it writes either channel order directly so BGR costs nothing extra
+# libjpeg-turbo has no interleaved YCbCr output, so ycbcr is left to PIL
+_TURBOJPEG_PIXEL_FORMATS = (
+    {
+        ("color", "RGB"): turbojpeg.TJPF_RGB,
+        ("color", "BGR"): turbojpeg.TJPF_BGR,
+        ("grayscale", "RGB"): turbojpeg.TJPF_GRAY,
+        ("grayscale", "BGR"): turbojpeg.TJPF_GRAY,
+    }
+    if _TURBOJPEG_IMPORTED
+    else {}
+)
+
 # https://en.wikipedia.org/wiki/YUV#SDTV_with_BT.601
 _M_RGB2YUV = [[0.299, 0.587, 0.114], [-0.14713, -0.28886, 0.436], [0.615, -0.51499, -0.10001]]
 
+_PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+_JPEG_SIGNATURE = b"\xff\xd8"
+# Start of frame markers, DHT (0xC4), JPG (0xC8) and DAC (0xCC) share the range but do not contain the image size
+_JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+# Markers without a length field
+_JPEG_STANDALONE_MARKERS = {0x01, 0xD0, 0xD1, 0xD2, 0xD3, 0xD4, 0xD5, 0xD6, 0xD7, 0xD8, 0xD9}
+_EXIF_ORIENTATION_TAG = 0x0112
+# Array views that undo each EXIF orientation, the same result as ImageOps.exif_transpose without a PIL image per step
+_EXIF_ORIENTATION_TRANSFORMS: dict[int, Callable[[np.ndarray], np.ndarray]] = {
+    2: lambda image: image[:, ::-1],
+    3: lambda image: image[::-1, ::-1],
+    4: lambda image: image[::-1],
+    5: lambda image: image.swapaxes(0, 1),
+    6: lambda image: image.swapaxes(0, 1)[:, ::-1],
+    7: lambda image: image[::-1, ::-1].swapaxes(0, 1),
+    8: lambda image: image.swapaxes(0, 1)[::-1],
+}
+# Default JPEG quality of Pillow, also used when saving with OpenCV so the output does not depend on the encoder used
+_PIL_DEFAULT_JPEG_QUALITY = 75
+
 
 # Taken from detectron2.data.detection_utils
 def convert_PIL_to_numpy(image, format):
@@ -46,53 +105,578 @@ def convert_PIL_to_numpy(image, format):
     return image
 
 
-def image_to_array_dpi(image, mode, ignore_exif) -> tuple[np.ndarray, Optional[int]]:
+def _read_png_header(f: BinaryIO) -> Optional[tuple[tuple[int, int], Optional[tuple[int, int]]]]:
+    """
+    Read the shape and DPI from the chunks of a PNG file, the file must be positioned directly after the signature
+
+    Args:
+        f (BinaryIO): PNG file object
+
+    Returns:
+        Optional[tuple[tuple[int, int], Optional[tuple[int, int]]]]: (height, width) and (x, y) DPI, None if the header is invalid
+    """
+    chunk_header = f.read(8)
+    if len(chunk_header) != 8 or chunk_header[4:] != b"IHDR":
+        return None
+    ihdr = f.read(8)
+    if len(ihdr) != 8:
+        return None
+    width, height = struct.unpack(">II", ihdr)
+    # Skip the remainder of IHDR and its CRC
+    f.seek(struct.unpack(">I", chunk_header[:4])[0] - 8 + 4, 1)
+
+    dpi = None
+    # pHYs must appear before the first IDAT chunk
+    while True:
+        chunk_header = f.read(8)
+        if len(chunk_header) != 8:
+            break
+        length = struct.unpack(">I", chunk_header[:4])[0]
+        chunk_type = chunk_header[4:]
+        if chunk_type in (b"IDAT", b"IEND"):
+            break
+        if chunk_type == b"pHYs" and length == 9:
+            phys = f.read(9)
+            if len(phys) != 9:
+                # Truncated inside the chunk, PIL cannot open this file either
+                return None
+            x_density, y_density, unit = struct.unpack(">IIB", phys)
+            # Unit 1 is pixels per meter
+            if unit == 1:
+                dpi = (int(x_density * 0.0254 + 0.5), int(y_density * 0.0254 + 0.5))
+            break
+        f.seek(length + 4, 1)
+
+    return (height, width), dpi
+
+
+def _read_exif_dpi(exif: bytes) -> tuple[int, int]:
+    """
+    Read the DPI from the resolution tags in IFD0 of EXIF data, the same way PIL does for JPEG files without a JFIF density
+
+    Args:
+        exif (bytes): EXIF data, starting at the TIFF header after the "Exif" identifier
+
+    Returns:
+        tuple[int, int]: (x, y) DPI, 72 (the PIL default) if the EXIF data does not contain a valid resolution
+    """
+    try:
+        byte_order = {b"II": "<", b"MM": ">"}[exif[:2]]
+        (ifd_offset,) = struct.unpack_from(f"{byte_order}I", exif, 4)
+        (num_entries,) = struct.unpack_from(f"{byte_order}H", exif, ifd_offset)
+        resolution_unit = None
+        x_resolution = None
+        for i in range(num_entries):
+            tag, tag_type, _, value = struct.unpack_from(f"{byte_order}HHI4s", exif, ifd_offset + 2 + i * 12)
+            if tag == 0x0128 and tag_type == 3:
+                # ResolutionUnit, a SHORT stored in the value field
+                (resolution_unit,) = struct.unpack_from(f"{byte_order}H", value)
+            elif tag == 0x011A and tag_type == 5:
+                # XResolution, a RATIONAL stored at the offset in the value field
+                (offset,) = struct.unpack(f"{byte_order}I", value)
+                numerator, denominator = struct.unpack_from(f"{byte_order}II", exif, offset)
+                x_resolution = numerator / denominator
+        if resolution_unit is None or x_resolution is None:
+            return 72, 72
+        # Unit 3 is dots per cm
+        dpi = int(x_resolution * (2.54 if resolution_unit == 3 else 1) + 0.5)
+        return dpi, dpi
+    except (KeyError, struct.error, ZeroDivisionError):
+        return 72, 72
+
+
+def _read_jpeg_info(f: BinaryIO) -> Optional[tuple[tuple[int, int], Optional[tuple[int, int]], bool]]:
+    """
+    Read the shape, DPI and presence of EXIF data from the markers of a JPEG file, the file must be positioned directly after the SOI marker
+
+    Args:
+        f (BinaryIO): JPEG file object
+
+    Returns:
+        Optional[tuple[tuple[int, int], Optional[tuple[int, int]], bool]]: (height, width), (x, y) DPI and if the file contains EXIF data,
+            None if the header is invalid
+    """
+    dpi = None
+    exif_dpi = None
+    has_exif = False
+    while True:
+        byte = f.read(1)
+        if byte != b"\xff":
+            return None
+        marker = f.read(1)
+        # Skip fill bytes
+        while marker == b"\xff":
+            marker = f.read(1)
+        if not marker:
+            return None
+        marker_code = marker[0]
+        if marker_code in _JPEG_STANDALONE_MARKERS:
+            continue
+        # Start of scan, reached the image data without finding the size
+        if marker_code == 0xDA:
+            return None
+        length_bytes = f.read(2)
+        if len(length_bytes) != 2:
+            return None
+        length = struct.unpack(">H", length_bytes)[0]
+        if length < 2:
+            return None
+
+        if marker_code == 0xE0 and dpi is None:
+            segment = f.read(length - 2)
+            if len(segment) >= 12 and segment[:5] == b"JFIF\x00":
+                unit = segment[7]
+                x_density, y_density = struct.unpack(">HH", segment[8:12])
+                # Unit 1 is dots per inch, unit 2 is dots per cm
+                if unit == 1:
+                    dpi = (x_density, y_density)
+                elif unit == 2:
+                    dpi = (int(x_density * 2.54 + 0.5), int(y_density * 2.54 + 0.5))
+        elif marker_code == 0xE1:
+            segment = f.read(length - 2)
+            if segment[:6] == b"Exif\x00\x00":
+                # PIL only uses the DPI of the first EXIF segment, and only when there is no JFIF density
+                if not has_exif:
+                    exif_dpi = _read_exif_dpi(segment[6:])
+                has_exif = True
+        elif marker_code in _JPEG_SOF_MARKERS:
+            segment = f.read(5)
+            if len(segment) != 5:
+                return None
+            height, width = struct.unpack(">HH", segment[1:5])
+            return (height, width), dpi if dpi is not None else exif_dpi, has_exif
+        else:
+            f.seek(length - 2, 1)
+
+
+def _read_jpeg_header(f: BinaryIO) -> Optional[tuple[tuple[int, int], Optional[tuple[int, int]]]]:
+    """
+    Read the shape and DPI from the markers of a JPEG file, the file must be positioned directly after the SOI marker
+
+    Args:
+        f (BinaryIO): JPEG file object
+
+    Returns:
+        Optional[tuple[tuple[int, int], Optional[tuple[int, int]]]]: (height, width) and (x, y) DPI, None if the header is invalid
+    """
+    info = _read_jpeg_info(f)
+    if info is None:
+        return None
+    shape, dpi, _ = info
+    return shape, dpi
+
+
+def _read_known_image_header(image_path: Path | str) -> Optional[tuple[tuple[int, int], Optional[tuple[int, int]]]]:
+    """
+    Read the shape and DPI of a PNG or JPEG image from its header
+
+    Args:
+        image_path (Path | str): Path to an image on the current filesystem.
+
+    Returns:
+        Optional[tuple[tuple[int, int], Optional[tuple[int, int]]]]: (height, width) and (x, y) DPI, None if the image is not a PNG or JPEG
+            or the header is invalid
+    """
+    with open(image_path, mode="rb") as f:
+        signature = f.read(8)
+        if signature == _PNG_SIGNATURE:
+            return _read_png_header(f)
+        elif signature[:2] == _JPEG_SIGNATURE:
+            f.seek(2)
+            return _read_jpeg_header(f)
+    return None
+
+
+def _dpi_to_int(dpi: Optional[tuple[float, float]]) -> Optional[int]:
+    """
+    Convert an (x, y) DPI to a single rounded DPI. Used for both the header parsers and the DPI PIL reports (a float for PNG pHYs
+    and JPEG dots per cm), so both give the same value for the same image
+
+    Args:
+        dpi (Optional[tuple[float, float]]): (x, y) DPI, None if the DPI is not set
+
+    Raises:
+        AssertionError: If the DPI is invalid or non-square.
+
+    Returns:
+        Optional[int]: The DPI, None if the DPI is not set.
+    """
+    if dpi is None:
+        return None
+    assert len(dpi) == 2, f"Invalid DPI: {dpi}"
+    if dpi[0] <= 0:
+        return None
+    assert dpi[0] == dpi[1], f"Non-square DPI: {dpi}"
+    return int(dpi[0] + 0.5)
+
+
+def _read_pil_image_header(image_path: Path | str) -> tuple[tuple[int, int], Optional[tuple[float, float]]]:
+    """
+    Read the shape and DPI of an image in any format PIL supports, PIL only parses the header until the image is loaded.
+    This reports the same DPI as the image loaders, which also get it from PIL
+
+    Args:
+        image_path (Path | str): Path to an image on the current filesystem.
+
+    Raises:
+        ValueError: If the image cannot be opened.
+
+    Returns:
+        tuple[tuple[int, int], Optional[tuple[float, float]]]: (height, width) and (x, y) DPI, None if the DPI is not set
+    """
+    try:
+        with Image.open(image_path) as image:
+            return (image.height, image.width), image.info.get("dpi")
+    except OSError as e:
+        raise ValueError(f"Cannot read image size: {image_path}") from e
+
+
+def read_image_dpi(image_path: Path | str) -> Optional[int]:
+    """
+    Read only the DPI of an image from its header, without opening the image with PIL. PNG (pHYs) and JPEG (JFIF/EXIF) are parsed
+    directly, other formats fall back to the header parsing of PIL
+
+    Args:
+        image_path (Path | str): Path to an image on the current filesystem.
+
+    Raises:
+        ValueError: If the image cannot be opened.
+        AssertionError: If the DPI is non-square.
+
+    Returns:
+        Optional[int]: The DPI, None if the DPI is not set.
+    """
+    header = _read_known_image_header(image_path)
+    if header is None:
+        header = _read_pil_image_header(image_path)
+    return _dpi_to_int(header[1])
+
+
+def read_image_header(image_path: Path | str) -> tuple[tuple[int, int], Optional[int]]:
+    """
+    Read the shape and DPI of an image from its header, opening the file only once. PNG and JPEG are parsed directly, other formats fall back to PIL
+
+    Args:
+        image_path (Path | str): Path to an image on the current filesystem.
+
+    Raises:
+        ValueError: If the shape of the image cannot be determined.
+        AssertionError: If the DPI is non-square.
+
+    Returns:
+        tuple[tuple[int, int], Optional[int]]: The (height, width) of the image and the DPI, None if the DPI is not set.
+    """
+    header = _read_known_image_header(image_path)
+    if header is None:
+        header = _read_pil_image_header(image_path)
+    shape, dpi = header
+    return shape, _dpi_to_int(dpi)
+
+
+_TURBOJPEG: Optional["turbojpeg.TurboJPEG"] = None
+_TURBOJPEG_LOCK = threading.Lock()
+
+
+def _get_turbojpeg() -> Optional["turbojpeg.TurboJPEG"]:
+    """
+    Get the TurboJPEG decoder shared by all threads, created on first use
+
+    Returns:
+        Optional[turbojpeg.TurboJPEG]: the decoder, None if PyTurboJPEG or the libjpeg-turbo library is not available
+    """
+    global _TURBOJPEG, _TURBOJPEG_IMPORTED
+    if not _TURBOJPEG_IMPORTED:
+        return None
+    if _TURBOJPEG is None:
+        with _TURBOJPEG_LOCK:
+            if _TURBOJPEG is None:
+                try:
+                    _TURBOJPEG = turbojpeg.TurboJPEG()
+                except (OSError, RuntimeError):
+                    # The python package is installed, but the libjpeg-turbo library itself cannot be found
+                    _TURBOJPEG_IMPORTED = False
+                    return None
+    return _TURBOJPEG
+
+
+# Grayscale JPEGs are decoded directly to their luminance (Y) plane. Before, they were decoded to RGB and converted to L,
+# which differs by up to 2 levels per pixel. Models trained on the old conversion can restore it with set_grayscale_from_rgb
+_GRAYSCALE_FROM_RGB = False
+
+
+def set_grayscale_from_rgb(enabled: bool) -> None:
+    """
+    Decode grayscale JPEGs to RGB and convert them to L, as done before the luminance plane was decoded directly.
+    This is slower, but gives exactly the pixel values of earlier versions, for example for inference with models trained on them
+
+    Args:
+        enabled (bool): convert from RGB instead of decoding the luminance plane directly
+    """
+    global _GRAYSCALE_FROM_RGB
+    _GRAYSCALE_FROM_RGB = enabled
+
+
+def _scale_dpi(dpi: Optional[int], original_side: int, side: int) -> Optional[int]:
+    """
+    Get the DPI of an image that was decoded at a reduced scale
+
+    Args:
+        dpi (Optional[int]): the DPI of the full size image
+        original_side (int): a side of the full size image
+        side (int): the same side of the decoded image
+
+    Returns:
+        Optional[int]: the DPI of the decoded image
+    """
+    if dpi is None or side == original_side:
+        return dpi
+    return max(1, round(dpi * side / original_side))
+
+
+def _jpeg_scale_denominator(shape: tuple[int, int], target_max_side: int) -> int:
+    """
+    Get the largest libjpeg DCT scaling (1/8, 1/4 or 1/2) that keeps the longest side at least target_max_side
+
+    Args:
+        shape (tuple[int, int]): the height and width of the full size image
+        target_max_side (int): the minimum size of the longest side after decoding
+
+    Returns:
+        int: the denominator of the scaling factor, 1 if the image should be decoded at full size
+    """
+    max_side = max(shape)
+    for denominator in (8, 4, 2):
+        # libjpeg rounds the scaled size up
+        if -(-max_side // denominator) >= target_max_side:
+            return denominator
+    return 1
+
+
+def _bytes_to_stream(image_bytes: bytes | mmap.mmap) -> BinaryIO:
+    """
+    Get a read-only file object over image bytes without copying them, positioned at the start
+
+    Args:
+        image_bytes (bytes | mmap.mmap): The image bytes.
+
+    Returns:
+        BinaryIO: The file object, the mapping itself for a mapped file.
+    """
+    if isinstance(image_bytes, mmap.mmap):
+        # A mapped file is already a file object
+        image_bytes.seek(0)
+        return image_bytes  # type: ignore
+    # BytesIO shares the buffer of a bytes object until it is written to, which PIL never does
+    # Wrapping a memoryview (or slice) instead would copy all bytes
+    return BytesIO(image_bytes)
+
+
+def jpeg_bytes_to_array_dpi(
+    image_bytes: bytes | mmap.mmap, mode: str, target_max_side: Optional[int] = None, image_format: str = "RGB"
+) -> Optional[tuple[np.ndarray, Optional[int]]]:
+    """
+    Decode JPEG bytes directly with libjpeg-turbo, skipping the PIL decoder and mode conversion
+
+    Args:
+        image_bytes (bytes | mmap.mmap): The image bytes to decode.
+        mode (str): The color mode of the image. Supported values are "color", "grayscale" and "ycbcr".
+        target_max_side (Optional[int], optional): Decode at the smallest DCT scale that keeps the longest side at least this size,
+            for when the image is resized afterwards. Defaults to None.
+        image_format (str, optional): Channel order of color images, "RGB" or "BGR" (for OpenCV). Defaults to "RGB".
+
+    Raises:
+        AssertionError: If the DPI is non-square.
+
+    Returns:
+        Optional[tuple[np.ndarray, Optional[int]]]: The image as a numpy array and the DPI (dots per inch) of the image.
+            None if the bytes are not a JPEG, if it contains EXIF data (which can hold an orientation and the DPI, these are left to PIL),
+            if libjpeg-turbo cannot decode it (for example CMYK or 12-bit JPEGs) or if libjpeg-turbo is not available.
+    """
+    decoder = _get_turbojpeg()
+    pixel_format = _TURBOJPEG_PIXEL_FORMATS.get((mode, image_format))
+    if decoder is None or pixel_format is None or image_bytes[:3] != b"\xff\xd8\xff":
+        return None
+    if mode == "grayscale" and _GRAYSCALE_FROM_RGB:
+        # libjpeg-turbo only outputs the luminance plane for grayscale, leave the conversion from RGB to PIL
+        return None
+    stream = _bytes_to_stream(image_bytes)
+    stream.seek(2)
+    info = _read_jpeg_info(stream)
+    if info is None:
+        return None
+    shape, dpi, has_exif = info
+    if has_exif:
+        return None
+
+    scaling_factor = None
+    if target_max_side is not None:
+        denominator = _jpeg_scale_denominator(shape, target_max_side)
+        if denominator > 1:
+            scaling_factor = (1, denominator)
+
+    try:
+        image = decoder.decode(image_bytes, pixel_format=pixel_format, scaling_factor=scaling_factor)
+    except OSError:
+        # libjpeg-turbo cannot convert every JPEG to RGB or grayscale (CMYK, YCCK, 12-bit), PIL can
+        return None
+    if mode == "grayscale":
+        image = image.reshape(image.shape[:2])
+
+    return image, _scale_dpi(_dpi_to_int(dpi), shape[1], image.shape[1])
+
+
+def image_to_array_dpi(
+    image, mode, ignore_exif, writable: bool = True, target_max_side: Optional[int] = None, image_format: str = "RGB"
+) -> tuple[np.ndarray, Optional[int]]:
     """
     Convert image to numpy array and get DPI
 
     Args:
         image (PIL.Image): The image to convert.
-        mode (str): The color mode of the image. Supported values are "color" and "grayscale".
+        mode (str): The color mode of the image. Supported values are "color", "grayscale" and "ycbcr".
         ignore_exif (bool): Whether to ignore the EXIF data of the image.
+        writable (bool, optional): Return a writable array, this costs a copy as PIL gives a read-only array. Defaults to True.
+        target_max_side (Optional[int], optional): Decode JPEGs at the smallest DCT scale that keeps the longest side at least this size,
+            for when the image is resized afterwards. Defaults to None.
+        image_format (str, optional): Channel order of color images, "RGB" or "BGR" (for OpenCV). Defaults to "RGB".
 
     Raises:
-        OSError: If the image is None after EXIF transpose.
         AssertionError: If the DPI is invalid or non-square.
 
     Returns:
         tuple[np.ndarray, Optional[int]]: The image as a numpy array and the DPI (dots per inch) of the image.
     """
+    original_width = image.width
+    if image.format == "JPEG":
+        draft_mode = None
+        draft_size = image.size
+        if mode == "grayscale" and image.mode != "L" and not _GRAYSCALE_FROM_RGB:
+            # Let libjpeg output the luminance directly, skipping the chroma upsampling and the conversion to RGB and back
+            # This matches the grayscale output of libjpeg-turbo in jpeg_bytes_to_array_dpi, see set_grayscale_from_rgb
+            draft_mode = "L"
+        elif mode == "ycbcr" and image.mode == "RGB":
+            # JPEGs are stored as YCbCr, return the decoded planes without the conversion to RGB
+            draft_mode = "YCbCr"
+        if target_max_side is not None:
+            # PIL picks the DCT scale that keeps the image at least the requested size
+            denominator = _jpeg_scale_denominator((image.height, image.width), target_max_side)
+            draft_size = (-(-image.width // denominator), -(-image.height // denominator))
+        if draft_mode is not None or draft_size != image.size:
+            image.draft(draft_mode, draft_size)
+    orientation_transform = None
     if not ignore_exif:
-        image = ImageOps.exif_transpose(image)
-        if image is None:
-            raise OSError("Image is None after exif transpose")
-    dpi = image.info.get("dpi")
-    if dpi is not None:
-        assert len(dpi) == 2, f"Invalid DPI: {dpi}"
-        assert dpi[0] == dpi[1], f"Non-square DPI: {dpi}"
-        dpi = dpi[0]
-    image = convert_PIL_to_numpy(image, "RGB" if mode == "color" else "L").copy()
+        orientation_transform = _EXIF_ORIENTATION_TRANSFORMS.get(image.getexif().get(_EXIF_ORIENTATION_TAG, 1))
+    dpi = _scale_dpi(_dpi_to_int(image.info.get("dpi")), original_width, image.width)
+    target_format = _PIL_MODES[mode]
+    # Converting to the same mode would only make a copy
+    image = np.asarray(image) if image.mode == target_format else convert_PIL_to_numpy(image, target_format)
+    if mode == "color" and image_format == "BGR":
+        # PIL only decodes to RGB, flip to a view here and copy once together with a rotation
+        image = image[..., ::-1]
+        image = np.ascontiguousarray(image if orientation_transform is None else orientation_transform(image))
+    elif orientation_transform is not None:
+        # Most images have no rotation, when they do the rotated view is copied once into a contiguous (and writable) array
+        image = np.ascontiguousarray(orientation_transform(image))
+    if writable and not image.flags.writeable:
+        image = image.copy()
     return image, dpi
 
 
+def normalize_image_array(
+    image: np.ndarray, mean: float | Sequence[float] | np.ndarray, std: float | Sequence[float] | np.ndarray
+) -> np.ndarray:
+    """
+    Normalize an image to (image - mean) / std as float32
+
+    The image is read once and the float32 result is written in place, without a float32 copy of the image in between
+
+    Args:
+        image (np.ndarray): the image, usually uint8
+        mean (float | Sequence[float] | np.ndarray): the mean, a single value or one per channel
+        std (float | Sequence[float] | np.ndarray): the standard deviation, a single value or one per channel
+
+    Returns:
+        np.ndarray: the normalized float32 image
+    """
+    normalized = np.empty(image.shape, dtype=np.float32)
+    np.subtract(image, np.asarray(mean, dtype=np.float32), out=normalized, dtype=np.float32)
+    np.divide(normalized, np.asarray(std, dtype=np.float32), out=normalized)
+    return normalized
+
+
+def _load_image_array(
+    image_bytes: bytes | mmap.mmap,
+    mode: str,
+    ignore_exif: bool,
+    writable: bool,
+    target_max_side: Optional[int],
+    image_format: str,
+    mean: Optional[float | Sequence[float] | np.ndarray],
+    std: Optional[float | Sequence[float] | np.ndarray],
+) -> dict:
+    """
+    Decode an encoded image, shared by the path and bytes loaders. See load_image_array_from_path for the arguments
+
+    Raises:
+        OSError: If the image cannot be decoded.
+
+    Returns:
+        dict: A dictionary containing the loaded image and dpi.
+    """
+    assert mode in _PIL_MODES, f'Mode "{mode}" not supported'
+    assert image_format in ["RGB", "BGR"], f'Image format "{image_format}" not supported'
+    assert (mean is None) == (std is None), "Normalizing requires both mean and std"
+    normalize = mean is not None
+    if normalize:
+        # The normalized image is a new array, so the loaded image does not need to be writable
+        writable = False
+
+    # JPEGs are decoded with libjpeg-turbo directly and by PIL otherwise
+    result = jpeg_bytes_to_array_dpi(image_bytes, mode, target_max_side, image_format)
+    if result is None:
+        image = Image.open(_bytes_to_stream(image_bytes))
+        result = image_to_array_dpi(
+            image, mode, ignore_exif, writable=writable, target_max_side=target_max_side, image_format=image_format
+        )
+    image, dpi = result
+    if normalize:
+        image = normalize_image_array(image, mean, std)  # type: ignore
+    return {"image": image, "dpi": dpi}
+
+
 def load_image_array_from_path(
     image_path: Path | str,
     mode: str = "color",
     ignore_exif: bool = False,
+    writable: bool = True,
+    target_max_side: Optional[int] = None,
+    image_format: str = "RGB",
+    mean: Optional[float | Sequence[float] | np.ndarray] = None,
+    std: Optional[float | Sequence[float] | np.ndarray] = None,
 ) -> Optional[dict]:
     """
     Load image from a given path, return None if loading failed due to corruption
 
     Args:
         image_path (Path | str): Path to an image on the current filesystem.
-        mode (str, optional): Color mode, either "color" or "grayscale". Defaults to "color".
+        mode (str, optional): Color mode, either "color", "grayscale" or "ycbcr". Defaults to "color".
         ignore_exif (bool, optional): Ignore exif orientation. Defaults to False.
+        writable (bool, optional): Make sure the loaded image is writable, set to False to skip a copy when the image is only read. Defaults to True.
+        target_max_side (Optional[int], optional): Decode JPEGs at a reduced scale (1/2, 1/4 or 1/8) that keeps the longest side
+            at least this size, for when the image is resized afterwards. The dpi is scaled along. Defaults to None.
+        image_format (str, optional): Channel order of color images, "RGB" or "BGR" (for OpenCV). Defaults to "RGB".
+        mean (Optional[float | Sequence[float] | np.ndarray], optional): Mean to normalize the loaded image with, see
+            normalize_image_array. Requires std. Defaults to None.
+        std (Optional[float | Sequence[float] | np.ndarray], optional): Standard deviation to normalize the loaded image with. Defaults to None.
 
     Returns:
         Optional[dict]: A dictionary containing the loaded image and dpi, or None if loading failed.
+            The image is float32 when normalized and uint8 otherwise.
 
     Raises:
         AssertionError: If the mode is not supported.
+        AssertionError: If the image format is not supported.
+        AssertionError: If only one of mean and std is given.
         AssertionError: If the DPI is invalid or non-square.
 
     Notes:
@@ -100,14 +684,18 @@ def load_image_array_from_path(
         - The loaded image is converted to a numpy array.
 
     """
-    assert mode in ["color", "grayscale"], f'Mode "{mode}" not supported'
-
     try:
-        image = Image.open(image_path)
-        image, dpi = image_to_array_dpi(image, mode, ignore_exif)
-        return {"image": image, "dpi": dpi}
+        with open(image_path, "rb") as f:
+            try:
+                # Map the file instead of reading it, the decoders read straight from the page cache without a copy
+                # The mapping stays valid after the file is closed and is released once the image is decoded
+                image_buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                # Empty files, pipes (such as /dev/stdin) and some network filesystems cannot be mapped, read these instead
+                # Reading from the already open file also works for a pipe, which cannot be opened a second time
+                image_buffer = f.read()
+        return _load_image_array(image_buffer, mode, ignore_exif, writable, target_max_side, image_format, mean, std)
     except OSError:
-        logger = logging.getLogger(get_logger_name())
         logger.warning(f"Cannot load image: {image_path} skipping for now")
         return None
 
@@ -117,6 +705,11 @@ def load_image_array_from_bytes(
     image_path: Optional[Path] = None,
     mode: str = "color",
     ignore_exif: bool = False,
+    writable: bool = True,
+    target_max_side: Optional[int] = None,
+    image_format: str = "RGB",
+    mean: Optional[float | Sequence[float] | np.ndarray] = None,
+    std: Optional[float | Sequence[float] | np.ndarray] = None,
 ) -> Optional[dict]:
     """
     Load an image from bytes and convert it to a numpy array.
@@ -124,8 +717,15 @@ def load_image_array_from_bytes(
     Args:
         image_bytes (bytes): The image bytes to load.
         image_path (Optional[Path], optional): The path to the image file. Defaults to None.
-        mode (str, optional): The color mode of the image. Supported values are "color" and "grayscale". Defaults to "color".
+        mode (str, optional): The color mode of the image. Supported values are "color", "grayscale" and "ycbcr". Defaults to "color".
         ignore_exif (bool, optional): Whether to ignore the EXIF data of the image. Defaults to False.
+        writable (bool, optional): Make sure the loaded image is writable, set to False to skip a copy when the image is only read. Defaults to True.
+        target_max_side (Optional[int], optional): Decode JPEGs at a reduced scale (1/2, 1/4 or 1/8) that keeps the longest side
+            at least this size, for when the image is resized afterwards. The dpi is scaled along. Defaults to None.
+        image_format (str, optional): Channel order of color images, "RGB" or "BGR" (for OpenCV). Defaults to "RGB".
+        mean (Optional[float | Sequence[float] | np.ndarray], optional): Mean to normalize the loaded image with, see
+            normalize_image_array. Requires std. Defaults to None.
+        std (Optional[float | Sequence[float] | np.ndarray], optional): Standard deviation to normalize the loaded image with. Defaults to None.
 
     Returns:
         Optional[dict]: A dictionary containing the loaded image as a numpy array and the DPI (dots per inch) of the image.
@@ -133,26 +733,244 @@ def load_image_array_from_bytes(
 
     Raises:
         AssertionError: If the specified mode is not supported.
+        AssertionError: If the image format is not supported.
+        AssertionError: If only one of mean and std is given.
         AssertionError: If the DPI is invalid or non-square.
 
     """
-    assert mode in ["color", "grayscale"], f'Mode "{mode}" not supported'
-
     try:
-        image = Image.open(BytesIO(image_bytes))
-        image, dpi = image_to_array_dpi(image, mode, ignore_exif)
-        return {"image": image, "dpi": dpi}
+        return _load_image_array(image_bytes, mode, ignore_exif, writable, target_max_side, image_format, mean, std)
     except OSError:
         image_path_info = image_path if image_path is not None else "Filename not given"
-        logger = logging.getLogger(get_logger_name())
         logger.warning(f"Cannot load image: {image_path_info}. skipping for now")
         return None
 
 
+def _load_image_array_resized_pyvips(image_path: Path | str, max_side: int, mode: str, ignore_exif: bool) -> dict:
+    """
+    Load an image at a reduced size with pyvips, which shrinks while decoding and streams the image instead of decoding it fully
+
+    Args:
+        image_path (Path | str): Path to an image on the current filesystem.
+        max_side (int): Maximum size of the longest side.
+        mode (str): Color mode, either "color" or "grayscale".
+        ignore_exif (bool): Ignore exif orientation.
+
+    Raises:
+        OSError: If the image cannot be loaded.
+
+    Returns:
+        dict: A dictionary containing the loaded image and dpi.
+    """
+    try:
+        # Only reads the header
+        original = pyvips.Image.new_from_file(str(image_path))
+        original_max_side = max(original.width, original.height)
+        image = pyvips.Image.thumbnail(str(image_path), max_side, height=max_side, size="down", no_rotate=ignore_exif)
+        # Drop the alpha channel
+        image = image.colourspace("srgb")[0:3]
+        if mode == "grayscale":
+            # The ITU-R 601-2 luma weights of PIL, the b-w colourspace of libvips goes through CIELAB and gives other values
+            image = (image.recomb([[0.299, 0.587, 0.114]]) + 0.5).cast("uchar")
+        elif image.format != "uchar":
+            image = image.cast("uchar")
+        image_array = np.ndarray(
+            buffer=image.write_to_memory(), dtype=np.uint8, shape=(image.height, image.width, image.bands)  # type: ignore
+        )
+    except pyvips.Error as e:
+        raise OSError(str(e)) from e
+    if mode == "grayscale":
+        image_array = image_array.reshape(image_array.shape[:2])
+    # Compare the longest sides, the image can be rotated by its EXIF orientation
+    dpi = _scale_dpi(read_image_dpi(image_path), original_max_side, max(image_array.shape[:2]))
+    return {"image": image_array, "dpi": dpi}
+
+
+def load_image_array_resized(
+    image_path: Path | str,
+    max_side: int,
+    mode: str = "color",
+    ignore_exif: bool = False,
+) -> Optional[dict]:
+    """
+    Load an image scaled down so its longest side is at most max_side, for example for previews of very large scans.
+    Images that are already small enough are not scaled up.
+
+    With pyvips installed the image is shrunk while decoding and streamed, so the full size image is never held in memory.
+    Otherwise JPEGs are decoded at a reduced DCT scale (see target_max_side in load_image_array_from_path) and resized with OpenCV.
+    The two backends resample differently, so the pixel values are not identical.
+
+    Args:
+        image_path (Path | str): Path to an image on the current filesystem.
+        max_side (int): Maximum size of the longest side.
+        mode (str, optional): Color mode, either "color", "grayscale" or "ycbcr". Defaults to "color".
+        ignore_exif (bool, optional): Ignore exif orientation. Defaults to False.
+
+    Returns:
+        Optional[dict]: A dictionary containing the loaded image and dpi (scaled along with the image), or None if loading failed.
+    """
+    assert mode in _PIL_MODES, f'Mode "{mode}" not supported'
+    assert max_side > 0, f"Invalid max side: {max_side}"
+
+    # libvips has no YCbCr colourspace, these are loaded with PIL
+    if _PYVIPS_IMPORTED and mode != "ycbcr":
+        try:
+            return _load_image_array_resized_pyvips(image_path, max_side, mode, ignore_exif)
+        except OSError:
+            logger.warning(f"Cannot load image: {image_path} skipping for now")
+            return None
+
+    data = load_image_array_from_path(image_path, mode, ignore_exif, writable=False, target_max_side=max_side)
+    if data is None:
+        return None
+    image = data["image"]
+    height, width = image.shape[:2]
+    scale = max_side / max(height, width)
+    if scale < 1:
+        new_width, new_height = max(1, round(width * scale)), max(1, round(height * scale))
+        image = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_AREA)
+        data = {"image": image, "dpi": _scale_dpi(data["dpi"], width, new_width)}
+    elif not image.flags.writeable:
+        data["image"] = image.copy()
+    return data
+
+
+def load_image_array_batch(
+    image_paths: Sequence[Path | str],
+    mode: str = "color",
+    ignore_exif: bool = False,
+    writable: bool = True,
+    num_workers: Optional[int] = None,
+) -> list[Optional[dict]]:
+    """
+    Load multiple images at once, decoding them in parallel threads (the JPEG and PNG decoders release the GIL)
+
+    Args:
+        image_paths (Sequence[Path | str]): Paths to images on the current filesystem.
+        mode (str, optional): Color mode, either "color", "grayscale" or "ycbcr". Defaults to "color".
+        ignore_exif (bool, optional): Ignore exif orientation. Defaults to False.
+        writable (bool, optional): Make sure the loaded images are writable. Defaults to True.
+        num_workers (Optional[int], optional): Number of decoding threads, None uses the ThreadPoolExecutor default. Defaults to None.
+
+    Returns:
+        list[Optional[dict]]: The loaded images and dpi in the order of the paths, None for images that failed to load.
+    """
+    assert mode in _PIL_MODES, f'Mode "{mode}" not supported'
+
+    if len(image_paths) <= 1:
+        return [load_image_array_from_path(image_path, mode, ignore_exif, writable) for image_path in image_paths]
+
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        return list(
+            executor.map(lambda image_path: load_image_array_from_path(image_path, mode, ignore_exif, writable), image_paths)
+        )
+
+
+class AsyncImageLoader:
+    """
+    Load images in background threads, while the caller is processing the previously loaded images.
+
+    The decoders release the GIL, so loading overlaps with the work done on the loaded images. For example:
+
+        with AsyncImageLoader(image_paths, prefetch=4) as loader:
+            for image_path, data in loader:
+                ...
+    """
+
+    def __init__(
+        self,
+        image_paths: Iterable[Path | str],
+        mode: str = "color",
+        ignore_exif: bool = False,
+        writable: bool = True,
+        num_workers: int = 2,
+        prefetch: int = 2,
+    ):
+        """
+        Load images in background threads, while the caller is processing the previously loaded images.
+
+        Args:
+            image_paths (Iterable[Path | str]): Paths to images on the current filesystem, loaded in order.
+            mode (str, optional): Color mode, either "color", "grayscale" or "ycbcr". Defaults to "color".
+            ignore_exif (bool, optional): Ignore exif orientation. Defaults to False.
+            writable (bool, optional): Make sure the loaded images are writable. Defaults to True.
+            num_workers (int, optional): Number of loading threads. Defaults to 2.
+            prefetch (int, optional): Number of images loaded ahead per thread, limits the memory used. Defaults to 2.
+        """
+        assert mode in _PIL_MODES, f'Mode "{mode}" not supported'
+        self.image_paths = iter(image_paths)
+        self.mode = mode
+        self.ignore_exif = ignore_exif
+        self.writable = writable
+        self.max_pending = max(1, num_workers * prefetch)
+
+        self._executor = ThreadPoolExecutor(max_workers=num_workers)
+        self._pending: deque[tuple[Path | str, Future]] = deque()
+
+    def submit(self, image_path: Path | str) -> Future:
+        """
+        Start loading a single image in the background
+
+        Args:
+            image_path (Path | str): Path to an image on the current filesystem.
+
+        Returns:
+            Future: Future with the result of load_image_array_from_path
+        """
+        return self._executor.submit(load_image_array_from_path, image_path, self.mode, self.ignore_exif, self.writable)
+
+    def _fill(self) -> None:
+        while len(self._pending) < self.max_pending:
+            image_path = next(self.image_paths, None)
+            if image_path is None:
+                break
+            self._pending.append((image_path, self.submit(image_path)))
+
+    def __iter__(self) -> Iterator[tuple[Path | str, Optional[dict]]]:
+        return self
+
+    def __next__(self) -> tuple[Path | str, Optional[dict]]:
+        """
+        Get the next loaded image, in the order of the given paths
+
+        Raises:
+            StopIteration: All images have been loaded
+
+        Returns:
+            tuple[Path | str, Optional[dict]]: The path and the loaded image and dpi, None if loading failed
+        """
+        self._fill()
+        if not self._pending:
+            raise StopIteration
+        image_path, future = self._pending.popleft()
+        # Start on the next image before waiting, so a thread is never idle while the caller is waiting
+        self._fill()
+        return image_path, future.result()
+
+    def close(self) -> None:
+        """
+        Stop loading, images that are not being loaded yet are cancelled
+        """
+        for _, future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self) -> "AsyncImageLoader":
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        self.close()
+        return False
+
+
 def save_image_array_to_path(
     image_path: Path | str,
     array: np.ndarray,
     dpi: Optional[int] = None,
+    compression: int = 6,
+    lossless: bool = False,
+    quality: Optional[int] = None,
 ):
     """
     Save image to a given path, log error in case of an error
@@ -161,15 +979,31 @@ def save_image_array_to_path(
         image_path (Path | str): The path where the image will be saved.
         array (np.ndarray): The image in array form (RGB between 0 and 255).
         dpi (Optional[int]): The DPI (dots per inch) of the saved image. Defaults to None.
+        compression (int, optional): The PNG compression level (0-9), lower is faster to encode but gives bigger files. Defaults to 6.
+        lossless (bool, optional): Use lossless compression for formats that are lossy by default (WebP). Defaults to False.
+        quality (Optional[int], optional): The quality (1-95) for lossy formats (JPEG, WebP), None uses the Pillow default. Defaults to None.
     """
     try:
-        # cv2.imwrite(str(image_path), array)
+        # OpenCV encodes JPEGs faster and releases the GIL while doing so, PIL is kept for the other formats and for DPI
+        if (
+            dpi is None
+            and Path(image_path).suffix.lower() in (".jpg", ".jpeg")
+            and array.dtype == np.uint8
+            and (array.ndim == 2 or (array.ndim == 3 and array.shape[2] in (1, 3)))
+        ):
+            if array.ndim == 3 and array.shape[2] == 3:
+                array = cv2.cvtColor(array, cv2.COLOR_RGB2BGR)
+            jpeg_quality = _PIL_DEFAULT_JPEG_QUALITY if quality is None else quality
+            if not cv2.imwrite(str(image_path), array, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality]):
+                raise OSError(f"OpenCV could not write {image_path}")
+            return
+
         image = Image.fromarray(array)
         if dpi is not None:
             image.info["dpi"] = (dpi, dpi)
-        image.save(image_path)
+        kwargs = {} if quality is None else {"quality": quality}
+        image.save(image_path, compress_level=compression, lossless=lossless, **kwargs)
     except OSError:
-        logger = logging.getLogger(get_logger_name())
         logger.warning(f"Cannot save image: {image_path}, skipping for now")
 
 
@@ -1,6 +1,8 @@
 import os
 import re
+from collections import defaultdict
 from pathlib import Path
+from typing import Sequence
 
 from utils.input_utils import SUPPORTED_IMAGE_FORMATS, is_path_supported_format
 
@@ -25,6 +27,35 @@ def check_path_accessible(path: Path):
     return True
 
 
+def check_paths_accessible(paths: Sequence[Path]):
+    """
+    Check if all provided paths are accessible, listing each parent directory once instead of checking every path separately
+    Args:
+        paths (Sequence[Path]): Paths to check
+    Raises:
+        TypeError: Path is not a Path object
+        FileNotFoundError: Dir/file does not exist at location
+        PermissionError: No read access for folder/file
+    """
+    paths_per_dir: defaultdict[Path, list[Path]] = defaultdict(list)
+    for path in paths:
+        if not isinstance(path, Path):
+            raise TypeError(f"provided object {path} is not Path, but {type(path)}")
+        paths_per_dir[path.parent].append(path)
+
+    for dir_path, dir_paths in paths_per_dir.items():
+        check_path_accessible(dir_path)
+        with os.scandir(dir_path) as entries:
+            entry_paths = {entry.name: entry.path for entry in entries}
+        for path in dir_paths:
+            if path.name not in entry_paths:
+                raise FileNotFoundError(f"Missing path: {path}")
+            if not os.access(path=entry_paths[path.name], mode=os.R_OK):
+                raise PermissionError(f"No access to {path} for read operations")
+
+    return True
+
+
 def image_path_to_xml_path(image_path: Path, check: bool = True) -> Path:
     """
     Return the corresponding xml path for a image
@@ -42,13 +42,14 @@ def point_line_segment_distance(line_segments: np.ndarray, points: np.ndarray) -
     return distances
 
 
-def point_at_start_or_end_assignment(line_segments: np.ndarray, points: np.ndarray) -> np.ndarray:
+def point_at_start_or_end_assignment(line_segments: np.ndarray, points_x: np.ndarray, points_y: np.ndarray) -> np.ndarray:
     """
     Find and remove points that are at the start or end of a line segment.
 
     Args:
         line_segments (np.ndarray): Array of line segment coordinates.
-        points (np.ndarray): Array of point coordinates.
+        points_x (np.ndarray): Array of point x coordinates.
+        points_y (np.ndarray): Array of point y coordinates.
 
     Returns:
         np.ndarray: Array of labels indicating if points are at the start or end of a line segment.
@@ -65,29 +66,32 @@ def point_at_start_or_end_assignment(line_segments: np.ndarray, points: np.ndarr
 
     # If the total length of the line is less than 2, do not remove any points
     if np.sum(line_norm) < 2:
-        return np.zeros(len(points))
+        return np.zeros(len(points_x))
     else:
         line_vector = line_vector[non_zero]
         line_ends = line_ends[non_zero]
         line_starts = line_starts[non_zero]
         line_norm = line_norm[non_zero]
 
-    start_to_points_vector = points[:, np.newaxis, :] - line_starts
-    start_to_points_norm = np.linalg.norm(start_to_points_vector, axis=2)
-    end_to_points_vector = points[:, np.newaxis, :] - line_ends
-    end_to_points_norm = np.linalg.norm(end_to_points_vector, axis=2)
+    # Keep the x and y components separate, instead of stacking the points into a (points, lines, 2) array
+    start_to_points_x = points_x[:, np.newaxis] - line_starts[:, 0]
+    start_to_points_y = points_y[:, np.newaxis] - line_starts[:, 1]
+    start_to_points_norm = np.sqrt(start_to_points_x * start_to_points_x + start_to_points_y * start_to_points_y)
+    end_to_points_x = points_x[:, np.newaxis] - line_ends[:, 0]
+    end_to_points_y = points_y[:, np.newaxis] - line_ends[:, 1]
+    end_to_points_norm = np.sqrt(end_to_points_x * end_to_points_x + end_to_points_y * end_to_points_y)
 
-    cross_product = start_to_points_vector[:, :, 0] * line_vector[:, 1] - start_to_points_vector[:, :, 1] * line_vector[:, 0]
+    cross_product = start_to_points_x * line_vector[:, 1] - start_to_points_y * line_vector[:, 0]
     line_to_points_norm = np.abs(cross_product) / line_norm
 
-    dot_product = start_to_points_vector[:, :, 0] * line_vector[:, 0] + start_to_points_vector[:, :, 1] * line_vector[:, 1]
+    dot_product = start_to_points_x * line_vector[:, 0] + start_to_points_y * line_vector[:, 1]
     dot_product_projection = dot_product / (line_norm * line_norm)
 
     mask_less_0 = dot_product_projection <= 0
     mask_more_1 = dot_product_projection >= 1
     mask_between_0_1 = np.logical_not(np.logical_or(mask_less_0, mask_more_1))
 
-    distances = np.zeros((len(points), len(line_vector)))
+    distances = np.zeros((len(points_x), len(line_vector)))
 
     distances[mask_less_0] = start_to_points_norm[mask_less_0]
     distances[mask_more_1] = end_to_points_norm[mask_more_1]
@@ -96,19 +100,13 @@ def point_at_start_or_end_assignment(line_segments: np.ndarray, points: np.ndarr
     min_values = np.min(distances, axis=1)
     is_min_value = distances == min_values[:, np.newaxis]
 
-    label = np.zeros(len(points))
+    label = np.zeros(len(points_x))
 
-    closest_to_start = np.any(is_min_value[:, [0]], axis=1)
-    closest_to_end = np.any(is_min_value[:, [-1]], axis=1)
+    closest_to_start = is_min_value[:, 0]
+    closest_to_end = is_min_value[:, -1]
 
-    for i, check in enumerate(closest_to_start):
-        if check:
-            if mask_less_0[i, 0]:
-                label[i] = 1
-    for i, check in enumerate(closest_to_end):
-        if check:
-            if mask_more_1[i, -1]:
-                label[i] = 1
+    label[np.logical_and(closest_to_start, mask_less_0[:, 0])] = 1
+    label[np.logical_and(closest_to_end, mask_more_1[:, -1])] = 1
 
     return label
 
@@ -229,13 +227,14 @@ def point_line_segment_side(line_segments: np.ndarray, points: np.ndarray) -> tu
     return (left_of_line_vector, right_of_line_vector, on_line_vector)
 
 
-def point_top_bottom_assignment(line_segments: np.ndarray, points: np.ndarray) -> np.ndarray:
+def point_top_bottom_assignment(line_segments: np.ndarray, points_x: np.ndarray, points_y: np.ndarray) -> np.ndarray:
     """
     Assign points to top or bottom sides of line segments based on minimum distance.
 
     Args:
         line_segments (np.ndarray): Array of line segment coordinates.
-        points (np.ndarray): Array of point coordinates.
+        points_x (np.ndarray): Array of point x coordinates.
+        points_y (np.ndarray): Array of point y coordinates.
 
     Returns:
         np.ndarray: Array of labels indicating the assigned side (top or bottom) for each point.
@@ -262,22 +261,25 @@ def point_top_bottom_assignment(line_segments: np.ndarray, points: np.ndarray) -
         line_norm = line_norm[non_zero]
 
     # Find closest line segment
-    start_to_points_vector = points[:, np.newaxis, :] - line_starts
-    start_to_points_norm = np.linalg.norm(start_to_points_vector, axis=2)
-    end_to_points_vector = points[:, np.newaxis, :] - line_ends
-    end_to_points_norm = np.linalg.norm(end_to_points_vector, axis=2)
-
-    cross_product = start_to_points_vector[:, :, 0] * line_vector[:, 1] - start_to_points_vector[:, :, 1] * line_vector[:, 0]
+    # Keep the x and y components separate, instead of stacking the points into a (points, lines, 2) array
+    start_to_points_x = points_x[:, np.newaxis] - line_starts[:, 0]
+    start_to_points_y = points_y[:, np.newaxis] - line_starts[:, 1]
+    start_to_points_norm = np.sqrt(start_to_points_x * start_to_points_x + start_to_points_y * start_to_points_y)
+    end_to_points_x = points_x[:, np.newaxis] - line_ends[:, 0]
+    end_to_points_y = points_y[:, np.newaxis] - line_ends[:, 1]
+    end_to_points_norm = np.sqrt(end_to_points_x * end_to_points_x + end_to_points_y * end_to_points_y)
+
+    cross_product = start_to_points_x * line_vector[:, 1] - start_to_points_y * line_vector[:, 0]
     line_to_points_norm = np.abs(cross_product) / line_norm
 
-    dot_product = start_to_points_vector[:, :, 0] * line_vector[:, 0] + start_to_points_vector[:, :, 1] * line_vector[:, 1]
+    dot_product = start_to_points_x * line_vector[:, 0] + start_to_points_y * line_vector[:, 1]
     dot_product_projection = dot_product / (line_norm * line_norm)
 
     mask_less_0 = dot_product_projection <= 0
     mask_more_1 = dot_product_projection >= 1
     mask_between_0_1 = np.logical_not(np.logical_or(mask_less_0, mask_more_1))
 
-    distances = np.zeros((len(points), len(line_vector)))
+    distances = np.zeros((len(points_x), len(line_vector)))
 
     distances[mask_less_0] = start_to_points_norm[mask_less_0]
     distances[mask_more_1] = end_to_points_norm[mask_more_1]
@@ -290,10 +292,15 @@ def point_top_bottom_assignment(line_segments: np.ndarray, points: np.ndarray) -
     min_count = np.sum(is_min_value, axis=1)
     min_occurs_more_than_once = min_count > 1
 
-    label = np.zeros(len(points))
+    label = np.zeros(len(points_x))
 
-    for i, check in enumerate(min_occurs_more_than_once):
-        if check:
+    # If there is a single minimum distance, assign the point to the line and the top or bottom side, done for all points at once
+    closest_cross_product = cross_product[np.arange(len(points_x)), np.argmax(is_min_value, axis=1)]
+    label[closest_cross_product > 0] = 1
+
+    # Only points with multiple minimum distances or on the line need the per point logic (in order, to keep the random draws the same)
+    for i in np.nonzero(np.logical_or(min_occurs_more_than_once, closest_cross_product == 0))[0]:
+        if min_occurs_more_than_once[i]:
             # If there are multiple minimum distances, assign the point to a line segment
             overlap_bool = consecutive_booleans(is_min_value[i])
             if not np.any(overlap_bool):
@@ -309,7 +316,7 @@ def point_top_bottom_assignment(line_segments: np.ndarray, points: np.ndarray) -
                 # for k in min_lines:
                 #     print(line[k:k+2])
                 #     plt.plot(line[k:k+2, 0], line[k:k+2, 1], color='g', linewidth=3)
-                # plt.scatter(points[i, 0], points[i, 1], color='r')
+                # plt.scatter(points_x[i], points_y[i], color='r')
                 # plt.show()
                 cross_product_i = cross_product[i, np.random.choice(min_lines)]
             else:
@@ -321,9 +328,7 @@ def point_top_bottom_assignment(line_segments: np.ndarray, points: np.ndarray) -
                     # Find what side of the middle vector the points and first line segment are on
                     middle_vector = line_vector[j] / line_norm[j] - line_vector[j + 1] / line_norm[j + 1]
 
-                    cross_product_1 = (
-                        end_to_points_vector[i, j, 0] * middle_vector[1] - end_to_points_vector[i, j, 1] * middle_vector[0]
-                    )
+                    cross_product_1 = end_to_points_x[i, j] * middle_vector[1] - end_to_points_y[i, j] * middle_vector[0]
                     cross_product_2 = -line_vector[j, 0] * middle_vector[1] + line_vector[j, 1] * middle_vector[0]
 
                     # Select the cross product of the assigned line segment
@@ -345,14 +350,8 @@ def point_top_bottom_assignment(line_segments: np.ndarray, points: np.ndarray) -
             else:
                 label[i] = 0
         else:
-            # If there is a single minimum distance, assign the point to the line and the top or bottom side
-            cross_product_i = cross_product[i, np.argwhere(is_min_value[i])]
-            if cross_product_i == 0:
-                label[i] = np.random.choice([0, 1])
-            elif cross_product_i > 0:
-                label[i] = 1
-            else:
-                label[i] = 0
+            # If there is a single minimum distance on the line, assign a random side
+            label[i] = np.random.choice([0, 1])
 
     return label
 
@@ -374,11 +373,9 @@ def draw_lines(lines: np.ndarray, thickness: int) -> np.ndarray:
     for line in lines:
         rounded_coords = np.round(line).astype(np.int32)
         cv2.polylines(empty_mask, [rounded_coords.reshape(-1, 1, 2)], False, (1,), thickness)
-        line_pixel_coords = np.column_stack(np.where(empty_mask == 1))[:, ::-1]
+        ys, xs = np.nonzero(empty_mask)
         empty_mask.fill(0)
-        mask[line_pixel_coords[:, 1], line_pixel_coords[:, 0]] = (
-            point_top_bottom_assignment(line, line_pixel_coords) + 1
-        ) * 100
+        mask[ys, xs] = (point_top_bottom_assignment(line, xs, ys) + 1) * 100
 
     return mask
 